@@ -1,5 +1,27 @@
+import atexit
+import logging
+
 from django.apps import AppConfig
 
+logger = logging.getLogger(__name__)
+
+
+def flush_buffers(buffers):
+    """Write what is still buffered when the server stops"""
+    for buffer in buffers:
+        try:
+            buffer.flush_now()
+        except Exception:
+            logger.exception('Could not write the buffered changes of %s on shutdown', type(buffer).__name__)
+
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        # Imported now rather than in the hook, importing while the interpreter shuts down fails
+        from .chat import chat
+        from .rooms import rooms
+
+        # The chat first, its messages go in rooms that may be closing
+        atexit.register(flush_buffers, (chat, rooms))
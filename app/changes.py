@@ -0,0 +1,109 @@
+import itertools
+import random
+import time
+from collections import OrderedDict, deque
+
+ADD = 'add'
+UPDATE = 'update'
+REMOVE = 'remove'
+CHANGES_KEPT = 500
+FRIENDS_LOGS_KEPT = 10000
+
+PROCESS_TAG_BITS = 20
+
+# Versions are shared by all the logs of the process and carry a random tag of the process in their low bits,
+# so a version handed out by another process (to a client reconnecting to another server) isn't taken for one
+# of this process, whose logs don't have the changes made there (unless both drew the same tag, about one
+# chance in a million, while their sequences overlap). They stay below 2**53 for javascript clients.
+_process_tag = random.getrandbits(PROCESS_TAG_BITS)
+_sequence = itertools.count(1)
+
+
+def next_version():
+    return next(_sequence) << PROCESS_TAG_BITS | _process_tag
+
+
+def from_this_process(version):
+    return version & ((1 << PROCESS_TAG_BITS) - 1) == _process_tag
+
+
+class ChangeLog:
+    """
+    The latest changes of a collection, so clients holding the version of an earlier snapshot
+    can catch up with the delta instead of fetching the collection again.
+    An 'update' only carries the fields that changed, 'add' carries the whole item.
+    """
+
+    def __init__(self, size=CHANGES_KEPT):
+        self.version = next_version()
+        # The oldest version the log can bring up to date
+        self.floor = self.version
+        self.created_at = time.monotonic()
+        self._changes = deque(maxlen=size)
+
+    def record(self, op, id, item=None):
+        if len(self._changes) == self._changes.maxlen: self.floor = self._changes[0][0]
+        self.version = next_version()
+        self._changes.append((self.version, op, id, item, time.monotonic()))
+        return self.version
+
+    def add(self, id, item):
+        return self.record(ADD, id, item)
+
+    def update(self, id, fields):
+        return self.record(UPDATE, id, fields)
+
+    def remove(self, id):
+        return self.record(REMOVE, id)
+
+    def since(self, version):
+        """The changes made after `version`, one per item, or None when the log can't tell and a snapshot is needed"""
+        if not from_this_process(version) or not self.floor <= version <= self.version: return None
+
+        changes = OrderedDict()
+        for change_version, op, id, item, _ in self._changes:
+            if change_version <= version: continue
+            previous = changes.pop(id, None)
+            if op == UPDATE and previous is not None and previous['op'] != REMOVE:
+                # Still an add if the client hasn't seen the item yet
+                op, item = previous['op'], {**previous['item'], **item}
+            changes[id] = {'op': op, 'id': id, 'item': item} if op != REMOVE else {'op': op, 'id': id}
+        return list(changes.values())
+
+    def version_before(self, seconds):
+        """
+        The version the log had `seconds` ago, for snapshots read from a replica that may be that far behind.
+        Below the floor when the log doesn't go back that far, the client will need a new snapshot to catch up.
+        """
+        if not seconds: return self.version
+        moment = time.monotonic() - seconds
+        for change_version, _, _, _, changed_at in reversed(self._changes):
+            if changed_at <= moment: return change_version
+        if self.created_at <= moment and len(self._changes) < self._changes.maxlen: return self.floor
+        return self.floor - 1
+
+
+class ChangeLogs:
+    """The change logs of the rooms, the users and the friends of every user"""
+
+    def __init__(self, friends_logs_kept=FRIENDS_LOGS_KEPT):
+        self.rooms = ChangeLog()
+        self.users = ChangeLog()
+        self.friends_logs_kept = friends_logs_kept
+        self._friends = OrderedDict()
+
+    def friends(self, user_pk, create=True):
+        """
+        The log of the friends of a user, only created when a snapshot of them is taken:
+        without one no client can ask for its changes, so they don't need to be recorded.
+        """
+        log = self._friends.get(user_pk)
+        if log is not None:
+            self._friends.move_to_end(user_pk)
+        elif create:
+            log = self._friends[user_pk] = ChangeLog()
+            if len(self._friends) > self.friends_logs_kept: self._friends.popitem(last=False)
+        return log
+
+
+change_logs = ChangeLogs()
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
+
+from .database import background, database_sync_to_async as s2as
+from .models import Room, Message
+
+logger = logging.getLogger(__name__)
+
+CHAT_FLUSH_SIZE = 200
+CHAT_FLUSH_INTERVAL = 0.5
+# Failed writes are retried, waiting twice as long after each failure up to this
+CHAT_RETRY_MAX_DELAY = 30
+MESSAGE_MAX_LENGTH = Message._meta.get_field('message_text').max_length
+
+
+class ChatBuffer:
+    """
+    The chat messages waiting to be written, in the order they were received.
+    They are broadcast as soon as they are added and written with one bulk insert
+    once `max_size` of them are waiting or `flush_interval` seconds after the first one.
+    A batch that fails to be written is retried before the batches after it are written.
+    """
+
+    def __init__(self, max_size=CHAT_FLUSH_SIZE, flush_interval=CHAT_FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._in_flight = []  # the batches flushed and not written yet
+        self._last_created_at = {}  # room pk -> created_at of its newest message
+        self._flush_handle = None
+        self._flush_loop = None
+        self._writing = None
+
+    def add(self, user, room_pk, message_text=None):
+        """Buffer a message and return it, it has no id until it is written"""
+        message_text = (message_text or '').strip()
+        if not message_text: raise ValueError('You must provide the message text')
+        if len(message_text) > MESSAGE_MAX_LENGTH: raise ValueError('The message is too long')
+
+        # The history is ordered by created_at, keep it strictly increasing in every room
+        created_at = timezone.now()
+        last = self._last_created_at.get(room_pk)
+        if last is not None and created_at <= last: created_at = last + timedelta(microseconds=1)
+        self._last_created_at[room_pk] = created_at
+
+        message = Message(author=user, room_id=room_pk, message_text=message_text, created_at=created_at)
+        self._pending.append(message)
+        if len(self._pending) >= self.max_size:
+            background(self.flush())
+        else:
+            self._schedule()
+        return message
+
+    def buffered(self, room_pk):
+        """The messages of the room that are not in the database yet"""
+        in_flight = [message for batch in list(self._in_flight) for message in batch]
+        return [message for message in in_flight + self._pending if message.room_id == room_pk]
+
+    def _schedule(self, delay=None):
+        loop = asyncio.get_event_loop()
+        if self._flush_handle is not None and self._flush_loop is loop: return
+        self._flush_loop = loop
+        self._flush_handle = loop.call_later(delay or self.flush_interval, lambda: background(self.flush()))
+
+    async def flush(self):
+        if self._flush_handle is not None: self._flush_handle.cancel()
+        self._flush_handle = None
+        if not self._pending: return
+        pending, self._pending = self._pending, []
+        self._in_flight.append(pending)
+        previous = self._writing
+        self._writing = background(self._write(previous, pending))
+        await self._writing
+
+    async def _write(self, previous, pending):
+        # Batches are written one at a time, a failed one is retried before the next, so the ids follow the order
+        # of the messages
+        if previous is not None and previous.get_loop() is asyncio.get_event_loop():
+            await asyncio.wait([previous])
+        failures = 0
+        while True:
+            try:
+                return await s2as(self._write_batch, critical=True)(pending)
+            except Exception:
+                failures += 1
+                delay = min(self.flush_interval * 2 ** failures, CHAT_RETRY_MAX_DELAY)
+                logger.exception('Could not write %d chat messages, retrying in %g seconds', len(pending), delay)
+                await asyncio.sleep(delay)
+
+    def _write_batch(self, batch):
+        write_messages(batch)
+        # In the database thread, right after the commit, so that a shutdown doesn't write the batch again
+        self._in_flight.remove(batch)
+
+    def flush_now(self):
+        """
+        Write the messages not written yet from the calling thread, used on shutdown when the event loop is gone.
+        Batches that were being written (or waiting for a retry) are written too.
+        """
+        in_flight, self._in_flight = self._in_flight, []
+        pending, self._pending = [message for batch in in_flight for message in batch] + self._pending, []
+        if pending: write_messages(pending)
+
+
+def write_messages(messages):
+    with transaction.atomic():
+        # The messages of a room deleted in the meantime went away with it
+        room_pks = set(Room.objects.filter(pk__in={message.room_id for message in messages}).values_list('pk', flat=True))
+        messages = [message for message in messages if message.room_id in room_pks]
+        Message.objects.bulk_create(messages)
+        # The messages are in the order they were received, the last one of a room is its newest
+        newest = {message.room_id: message.created_at for message in messages}
+        if newest:
+            Room.objects.filter(pk__in=newest).update(last_activity_at=Case(
+                *[When(pk=room_pk, then=Value(created_at)) for room_pk, created_at in newest.items()],
+                output_field=DateTimeField()))
+
+
+chat = ChatBuffer()
@@ -1,84 +1,103 @@
-import json
+import logging
+import time
 
-from asgiref.sync import sync_to_async as s2as, async_to_sync as as2s
-# from channels.db import database_sync_to_async as s2as
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth.models import AnonymousUser
 from django.db import IntegrityError
 
-from .models import User, Room, Post
+from .changes import change_logs, ADD, REMOVE
+from .chat import chat
+from .database import database_sync_to_async as s2as
+from .friends import friend_graph
+from .directory import user_directory
+from .dispatch import Dispatcher, DispatchMixin, field, optional, query_budget, read_only, ID, NUMBER
+from .models import User, Token, Room, Message, Post, Comment
+from .pagination import page_size
+from .playback import playback
+from .groups import user_group, room_group, topic_group
+from .hashing import password_hashing, ServerBusy
+from .presence import presence
+from .protocol import group_frame
+from .rooms import rooms
+from .routers import replica_lag
+from .serializers import UserSerializer, UserMinSerializer, RoomSerializer, RoomPreviewSerializer, \
+    MessageSerializer, PostSerializer, CommentSerializer, format_datetime
+
+logger = logging.getLogger(__name__)
+
+
+class AuthConsumer(DispatchMixin, AsyncWebsocketConsumer):
+    dispatcher = Dispatcher()
 
-
-def format_message(type, data):
-    return json.dumps({
-        'type': type, 'data': data
-    })
-
-
-def format_message_reverse(json_data):
-    data = json.loads(json_data)
-    return data.get('type'), data.get('data')
-
-
-def users_to_dicts(users, min_dict=True):
-    if min_dict:
-        return [user.as_min_dict() for user in users]
-    return [user.as_dict() for user in users]
-
-
-def rooms_to_dicts(rooms, min_dict=True):
-    if min_dict:
-        return [room.as_preview_dict() for room in rooms]
-    return [room.as_dict() for room in rooms]
-
-
-class AuthConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        print('new connection')
         await self.accept()
 
-    async def receive(self, text_data=None, bytes_data=None):
-        type, data = format_message_reverse(text_data)
-        if type == 'signup':
-            await self.handleSignup(data)
-        elif type == 'login':
-            await self.handleLogin(data)
-
-    async def handleSignup(self, data):
+    @dispatcher.handler('signup', email=str, name=str, password=str)
+    async def handleSignup(self, email, name, password):
         try:
-            user = await s2as(User.objects.create_user)(email=data['email'], name=data['name'],
-                                                        password=data['password'])
-            await s2as(user.save)()
-            auth_user = await s2as(User.objects.authenticate)(user.email, data['password'])
-            await self.send(
-                format_message('signup_success', {
-                    'user': await s2as(auth_user['user'].as_dict)(),
-                    'token': auth_user['token']
-                }))
+            User.objects.validate_user(email, password)
+            password_hash = await password_hashing.hash(password)
+            user = await s2as(User.objects.create_user, critical=True)(email=email, name=name, password=password,
+                                                                       password_hash=password_hash)
+            # The password was just hashed, no need to check it again
+            auth_user = await s2as(User.objects.log_in, critical=True)(user)
+            change_logs.users.add(user.pk, UserMinSerializer.to_dict(auth_user['user']))
+            await self.send_frame('signup_success', {
+                'user': await s2as(UserSerializer.one)(auth_user['user']),
+                'token': auth_user['token']
+            })
         except IntegrityError:
-            await self.send(format_message('signup_error', f'The email {data["email"]} is already taken'))
-        except ValueError as exc:
-            await self.send(format_message('signup_error', str(exc)))
+            await self.send_frame('signup_error', f'The email {email} is already taken')
+        except (ValueError, ServerBusy) as exc:
+            await self.send_frame('signup_error', str(exc))
 
-    async def handleLogin(self, data):
-        user = await s2as(User.objects.authenticate)(email=data['email'], password=data['password'])
+    @dispatcher.handler('login', email=str, password=str)
+    async def handleLogin(self, email, password):
+        try:
+            user = await s2as(User.objects.get_for_login)(email=email, password=password)
+            if user and await password_hashing.check(password, user.password):
+                user = await s2as(User.objects.log_in, critical=True)(user)
+            else:
+                user = None
+        except (ValueError, ServerBusy) as exc:
+            return await self.send_frame('login_error', str(exc))
         if not user:
-            print('wrong credentials')
-            return await self.send(format_message('login_error', 'No account matches the this email and password'))
+            logger.info('Failed login for %s', email)
+            return await self.send_frame('login_error', 'No account matches the this email and password')
 
-        print('user logged in successfully')
-        await self.send(format_message('login_success', {
-            'user': await s2as(user['user'].as_dict)(),
+        await self.send_frame('login_success', {
+            'user': await s2as(UserSerializer.one)(user['user']),
             'token': user['token']
-        }))
+        })
 
 
-class GlobalConsumer(AsyncWebsocketConsumer):
-    async def notify_all(self, type, data):
-        await self.channel_layer.group_send('global', {
-            'type': 'websocket.send',
-            'text': format_message(type, data)
-        })
+class GlobalConsumer(DispatchMixin, AsyncWebsocketConsumer):
+    dispatcher = Dispatcher()
+    room_pk = None
+    room_group = None
+    # The sort of the rooms listed to this connection and their ids, what the rooms deltas cover
+    rooms_sort = None
+    listed_rooms = frozenset()
+
+    async def notify(self, group, type, data):
+        await self.channel_layer.group_send(group, group_frame(type, data))
+
+    async def add_group(self, group):
+        self.subscriptions.add(group)
+        await self.channel_layer.group_add(group, self.channel_name)
+
+    async def discard_group(self, group):
+        self.subscriptions.discard(group)
+        await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def set_room(self, room_pk):
+        """Move the connection to the group of the room it is watching"""
+        group = room_group(room_pk) if room_pk else None
+        if group == self.room_group: return
+        if self.room_group: await self.discard_group(self.room_group)
+        if group: await self.add_group(group)
+        self.room_pk = room_pk
+        self.room_group = group
 
     async def connect(self):
         token = self.scope['url_route']['kwargs']['token']
@@ -86,234 +105,489 @@ class GlobalConsumer(AsyncWebsocketConsumer):
 
         if user:
             self.scope['user'] = user['user']
+            self.subscriptions = set()
             await self.accept()
-            await self.notify_all('online_user', {'user': user['user'].as_min_dict()})
-            await self.channel_layer.group_add('global', self.channel_name)
-            user['user'].channel_name = self.channel_name
-            await s2as(user['user'].save)()
+            await self.add_group(user_group(user['user'].pk))
+            await self.set_room(rooms.user_room(user['user'].pk, user['user'].room_id))
+            await presence.connect(user['user'].pk, self.channel_name)
             await self.get_profile()
         else:
             await self.close()
 
     async def disconnect(self, code=None):
         user = self.scope['user']
-        user.is_online = False
-        user.channel_name = ''
-        await s2as(user.save)()
-        await self.channel_layer.group_discard('global', self.channel_name)
-        await self.notify_all('offline_user', {'user': user.as_min_dict()})
+        if user.pk is not None:
+            await presence.disconnect(user.pk, self.channel_name)
+            for group in list(self.subscriptions):
+                await self.discard_group(group)
         await self.close()
 
+    @dispatcher.handler('logout')
     async def logout(self):
-        user = self.scope['user']
-        token_to_remove = self.scope['url_route']['kwargs']['token']
-        tokens = json.loads(user.tokens)
-        tokens.remove(token_to_remove)
-        user.tokens = json.dumps(tokens)
-        await s2as(user.save)()
+        token = self.scope['url_route']['kwargs']['token']
+        await s2as(Token.objects.revoke, critical=True)(token)
         await self.disconnect()
 
-    async def websocket_send(self, message):
-        type, data = format_message_reverse(message['text'])
-        await self.send(format_message(type, data))
+    async def leave_current_room(self):
+        """A user watches one room at a time, leave the current one before going to another"""
+        if not self.room_pk: return
+        try:
+            await self.exit_room(self.room_pk)
+        except (ValueError, Room.DoesNotExist):
+            pass
+
+    async def exit_room(self, room_pk):
+        """Leave a room, its playback goes away with it when it closes after its last member"""
+        await rooms.leave(room_pk, self.scope['user'].pk)
+        if room_pk in rooms.closed_rooms: await playback.close(room_pk)
+
+    def record_friendship(self, friend_pk, friend=None):
+        """
+        Record a friend added (`friend` is its min dict) or removed in the friend graph
+        and the friends change logs of both users
+        """
+        user = self.scope['user']
+        log, friend_log = change_logs.friends(user.pk, create=False), change_logs.friends(friend_pk, create=False)
+        if friend is None:
+            friend_graph.remove(user.pk, friend_pk)
+            if log: log.remove(friend_pk)
+            if friend_log: friend_log.remove(user.pk)
+        else:
+            friend_graph.add(user.pk, friend_pk)
+            if log: log.add(friend_pk, friend)
+            # The user is connected, is_online may not be up to date on the instance of the scope
+            if friend_log: friend_log.add(user.pk, {**UserMinSerializer.to_dict(user), 'is_online': True})
+
+    async def room_closed(self, message):
+        """Sent to the group of a room when it gets deleted"""
+        if self.room_group == room_group(message['room']['id']):
+            await self.set_room(None)
+        # The subscribers of the rooms topic get it from there
+        if topic_group('rooms') not in self.subscriptions:
+            await self.send_frame('room_deleted', {'room': message['room']})
+
+    @dispatcher.handler('time_sync', client_time=NUMBER)
+    async def time_sync(self, client_time):
+        """
+        One NTP style exchange: the client sends its time t0, and notes t3 when the reply arrives,
+        its clock is `((server_receive_time - t0) + (server_send_time - t3)) / 2` behind the server's
+        """
+        server_receive_time = time.time()
+        await self.send_frame('time_sync', {
+            'client_time': client_time,
+            'server_receive_time': server_receive_time,
+            'server_send_time': time.time()
+        })
 
-    async def receive(self, text_data=None, bytes_data=None):
-        type, data = format_message_reverse(text_data)
-        if type == 'logout':
-            await self.logout()
-        elif type == 'profile':
-            await self.get_profile()
-        elif type == 'rooms':
-            await self.get_rooms()
-        elif type == 'users':
-            await self.get_users()
-        elif type == 'user':
-            if data.get('id'):
-                await self.get_user(data['id'])
-        elif type == 'add_friend':
-            if data.get('id'):
-                await self.add_friend(data['id'])
-        elif type == 'remove_friend':
-            if data.get('id'):
-                await self.remove_friend(data['id'])
-        elif type == 'create_room':
-            if data.get('videoURL') and data.get('name'):
-                await self.create_room(data['videoURL'], data['name'])
-        elif type == 'join_room':
-            if data.get('id'):
-                await self.join_room(data['id'])
-        elif type == 'leave_room':
-            await self.leave_room()
-        elif type == 'delete_room':
-            await self.delete_room()
-        elif type == 'get_posts':
-            await self.get_posts()
-        elif type == 'create_post':
-            if data.get('post'): await self.create_post(data['post'])
-        elif type == 'delete_post':
-            if data.get('id'): await self.delete_post(data['id'])
-        elif type == 'update_post':
-            if data.get('id') and data.get('text'): await self.update_post(data['id'], data['text'])
-        elif type == 'create_comment':
-            if data.get('id') and data.get('comment_text'):
-                await self.create_comment(data['id'], data['comment_text'])
-        elif type == 'update_comment':
-            if data.get('id') and data.get('comment_text'):
-                await self.update_comment(data['id'], data['comment_text'])
-        elif type == 'delete_comment':
-            if data.get('id'): await self.delete_comment(data['id'])
-        elif type == 'like_post':
-            if data.get('id'): await self.like_post(data['id'])
+    @dispatcher.handler('playback')
+    async def get_playback(self):
+        if not self.room_pk:
+            return await self.send_frame('playback_error', 'You must be in a room first')
+        state = await playback.get(self.room_pk)
+        await self.send_frame('playback', {'room': self.room_pk, **state.as_dict()})
+
+    @dispatcher.handler('play', position=optional(NUMBER))
+    async def play(self, position=None):
+        await self.update_playback('play', 'play', position)
+
+    @dispatcher.handler('pause', position=optional(NUMBER))
+    async def pause(self, position=None):
+        await self.update_playback('pause', 'pause', position)
+
+    @dispatcher.handler('seek', position=NUMBER)
+    async def seek(self, position):
+        await self.update_playback('seek', 'seek', position)
+
+    @dispatcher.handler('playback_rate', rate=NUMBER)
+    async def set_playback_rate(self, rate):
+        await self.update_playback('playback_rate', 'set_rate', rate)
+
+    async def update_playback(self, type, action, *args):
+        """Change the playback of the room and send the new state to everyone watching it"""
+        if not self.room_pk:
+            return await self.send_frame(f'{type}_error', 'You must be in a room first')
+        try:
+            state = await playback.update(self.room_pk, action, *args)
+        except ValueError as err:
+            return await self.send_frame(f'{type}_error', str(err))
+        await self.notify(self.room_group, 'playback', {'room': self.room_pk, **state.as_dict()})
+
+    @dispatcher.handler('subscribe', topic=str)
+    async def subscribe(self, topic):
+        try:
+            await self.add_group(topic_group(topic))
+            await self.send_frame('subscribe_success', {'topic': topic})
+        except ValueError as err:
+            await self.send_frame('subscribe_error', str(err))
 
+    @dispatcher.handler('unsubscribe', topic=str)
+    async def unsubscribe(self, topic):
+        try:
+            await self.discard_group(topic_group(topic))
+            await self.send_frame('unsubscribe_success', {'topic': topic})
+        except ValueError as err:
+            await self.send_frame('unsubscribe_error', str(err))
+
+    @dispatcher.handler('like_post', post_id=field(ID, key='id'))
     async def like_post(self, post_id):
         user = self.scope['user']
         try:
-            await s2as(user.like_post)(post_id)
-            await self.send(format_message('like_post_success', {'id': post_id}))
+            await s2as(user.like_post, critical=True)(post_id)
+            await self.send_frame('like_post_success', {'id': post_id})
         except ValueError as err:
-            await self.send('like_post_error', str(err))
+            await self.send_frame('like_post_error', str(err))
 
+    @dispatcher.handler('delete_comment', comment_id=field(ID, key='id'))
     async def delete_comment(self, comment_id):
         user = self.scope['user']
         try:
-            await s2as(user.delete_comment)(comment_id)
-            await self.send(format_message('delete_comment_success', {}))
+            await s2as(user.delete_comment, critical=True)(comment_id)
+            await self.send_frame('delete_comment_success', {})
         except ValueError as err:
-            await self.send('delete_comment_error', str(err))
+            await self.send_frame('delete_comment_error', str(err))
 
+    @dispatcher.handler('update_comment', comment_id=field(ID, key='id'), comment_text=str)
     async def update_comment(self, comment_id, comment_text):
         user = self.scope['user']
         try:
-            comment = await s2as(user.update_comment)(comment_id, comment_text)
-            await self.send(format_message('update_comment_success', {
-                'comment': await s2as(comment.as_dict)()
-            }))
+            comment = await s2as(user.update_comment, critical=True)(comment_id, comment_text)
+            await self.send_frame('update_comment_success', {
+                'comment': await s2as(CommentSerializer.one)(comment)
+            })
         except ValueError as err:
-            await self.send(format_message('update_comment_error', str(err)))
+            await self.send_frame('update_comment_error', str(err))
 
+    @dispatcher.handler('create_comment', post_id=field(ID, key='id'), comment_text=str)
     async def create_comment(self, post_id, comment_text):
         user = self.scope['user']
         try:
-            comment = await s2as(user.comment_post)(post_id, comment_text)
-            await self.send(format_message('create_comment_success', {
-                'comment': await s2as(comment.as_dict)()
-            }))
+            comment = await s2as(user.comment_post, critical=True)(post_id, comment_text)
+            await self.send_frame('create_comment_success', {
+                'comment': await s2as(CommentSerializer.one)(comment)
+            })
         except ValueError as err:
-            await self.send(format_message('create_comment_error', str(err)))
+            await self.send_frame('create_comment_error', str(err))
 
+    @dispatcher.handler('update_post', id=ID, new_text=field(str, key='text'))
     async def update_post(self, id, new_text):
         user = self.scope['user']
         try:
-            post = await s2as(user.update_post)(id, new_text)
-            await self.send(format_message('update_post_success', {
-                'post': post
-            }))
+            post = await s2as(user.update_post, critical=True)(id, new_text)
+            await self.send_frame('update_post_success', {
+                'post': await s2as(PostSerializer.one)(post)
+            })
         except ValueError as err:
-            await self.send(format_message('update_post_error', str(err)))
+            await self.send_frame('update_post_error', str(err))
 
+    @dispatcher.handler('delete_post', id=ID)
     async def delete_post(self, id):
         user = self.scope['user']
         try:
-            await s2as(user.delete_post)(id)
-            await self.send(format_message('delete_post_success', {}))
+            await s2as(user.delete_post, critical=True)(id)
+            await self.send_frame('delete_post_success', {})
         except ValueError as err:
-            await self.send(format_message('delete_post_error', str(err)))
+            await self.send_frame('delete_post_error', str(err))
+
+    @dispatcher.handler('send_message', message_text=field(str, key='message'))
+    async def send_message(self, message_text):
+        if not self.room_pk:
+            return await self.send_frame('send_message_error', 'You must be in a room first')
+        try:
+            message = chat.add(self.scope['user'], self.room_pk, message_text)
+        except ValueError as err:
+            return await self.send_frame('send_message_error', str(err))
+        await self.send_frame('send_message_success', {
+            'room': self.room_pk,
+            'created_at': format_datetime(message.created_at)
+        })
+        await self.notify(self.room_group, 'message', {
+            'room': self.room_pk,
+            'message': MessageSerializer.to_dict(message)
+        })
 
+    @dispatcher.handler('create_post', post_text=field(str, key='post'))
     async def create_post(self, post_text):
         user = self.scope['user']
         try:
-            post = await s2as(user.create_post)(post_text)
-            await self.send(format_message('create_post_success', {
-                'post': await s2as(post.as_dict)()
-            }))
+            post = await s2as(user.create_post, critical=True)(post_text)
+            await self.send_frame('create_post_success', {
+                'post': await s2as(PostSerializer.one)(post)
+            })
         except ValueError as err:
-            await self.send(format_message('create_post_error', str(err)))
+            await self.send_frame('create_post_error', str(err))
 
-    async def get_posts(self):
-        posts = await s2as(Post.objects.order_by)('-posted_at')
-        await self.send(format_message('posts', {'posts': users_to_dicts(posts, min_dict=False)}))
+    @dispatcher.handler('get_posts', cursor=optional(str), limit=optional(ID))
+    @read_only
+    @query_budget(3)
+    async def get_posts(self, cursor=None, limit=None):
+        try:
+            posts, next_cursor = await s2as(Post.objects.page)(cursor=cursor, limit=page_size(limit))
+        except ValueError as err:
+            return await self.send_frame('posts_error', str(err))
 
-    async def delete_room(self):
-        user = self.scope['user']
+        await self.send_frame('posts', {
+            'posts': await s2as(PostSerializer.many)(posts),
+            'next_cursor': next_cursor
+        })
+
+    @dispatcher.handler('get_comments', post_id=field(ID, key='id'), cursor=optional(str), limit=optional(ID))
+    @read_only
+    async def get_comments(self, post_id, cursor=None, limit=None):
         try:
-            room = await s2as(user.room.as_dict)()
-            user = await s2as(user.delete_room)()
-            await self.send(format_message('delete_room_success', {
-                'user': await s2as(user.as_dict)()
-            }))
-            await self.notify_all('room_deleted', {'room': room})
+            comments, next_cursor = await s2as(Comment.objects.page)(post_id, cursor=cursor, limit=page_size(limit))
         except ValueError as err:
-            await self.send(format_message('delete_room_error', str(err)))
+            return await self.send_frame('comments_error', str(err))
 
-    async def leave_room(self):
-        user = self.scope['user']  # :type User
+        await self.send_frame('comments', {
+            'id': post_id,
+            'comments': await s2as(CommentSerializer.many)(comments),
+            'next_cursor': next_cursor
+        })
+
+    @dispatcher.handler('room_history', room_id=field(ID, key='id'), cursor=optional(str), limit=optional(ID))
+    @read_only
+    async def get_room_history(self, room_id, cursor=None, limit=None):
         try:
-            user = await s2as(user.leave_room)()
-            await self.send(format_message('leave_room_success', {
-                'user': user
-            }))
+            messages, next_cursor = await s2as(Message.objects.page)(room_id, cursor=cursor, limit=page_size(limit))
         except ValueError as err:
-            await self.send(format_message('leave_room_error', str(err)))
+            return await self.send_frame('room_history_error', str(err))
 
-    async def join_room(self, id):
+        await self.send_frame('room_history', {
+            'id': room_id,
+            'messages': await s2as(MessageSerializer.many)(reversed(messages)),
+            'next_cursor': next_cursor
+        })
+
+    @dispatcher.handler('delete_room')
+    async def delete_room(self):
+        user = self.scope['user']
+        try:
+            if not self.room_pk: raise ValueError('You must be in a room first')
+            room = await s2as(RoomSerializer.get)(pk=self.room_pk)
+            room.update(await rooms.delete(self.room_pk, user.pk))
+            user.room_id = None
+            await self.send_frame('delete_room_success', {
+                'user': await s2as(UserSerializer.one)(user)
+            })
+            await self.set_room(None)
+            await playback.close(room['id'])
+            await self.channel_layer.group_send(room_group(room['id']), {'type': 'room.closed', 'room': room})
+            await self.notify(topic_group('rooms'), 'room_deleted', {'room': room})
+        except (ValueError, Room.DoesNotExist) as err:
+            await self.send_frame('delete_room_error', str(err))
+
+    @dispatcher.handler('leave_room')
+    async def leave_room(self):
         user = self.scope['user']  # :type User
         try:
-            room = await s2as(user.join_room)(id)
-            await self.send(format_message('join_room_success', {
-                'room': await s2as(room.as_dict)()
-            }))
-        except User.DoesNotExist:
-            await self.send(format_message('join_room_error', 'Room not found'))
-
+            if not self.room_pk: raise ValueError('You must in a room first')
+            await self.exit_room(self.room_pk)
+            user.room_id = None
+            await self.set_room(None)
+            await self.send_frame('leave_room_success', {
+                'user': await s2as(UserSerializer.one)(user)
+            })
+        except (ValueError, Room.DoesNotExist) as err:
+            await self.send_frame('leave_room_error', str(err))
+
+    @dispatcher.handler('join_room', room_pk=field(ID, key='id'))
+    @query_budget(6)
+    async def join_room(self, room_pk):
+        user = self.scope['user']  # :type User
+        try:
+            actor = await rooms.join(room_pk, user)
+            if self.room_pk != room_pk: await self.leave_current_room()
+            user.room_id = room_pk
+            await self.set_room(room_pk)
+            room = await s2as(RoomSerializer.get)(pk=room_pk)
+            room.update(actor.snapshot())
+            RoomSerializer.add_buffered(room, chat.buffered(room_pk))
+            state = await playback.get(room_pk)
+            await self.send_frame('join_room_success', {
+                'room': room,
+                'playback': state.as_dict()
+            })
+        except Room.DoesNotExist:
+            await self.send_frame('join_room_error', 'Room not found')
+
+    @dispatcher.handler('create_room', video_url=field(str, key='videoURL'), name=str)
     async def create_room(self, video_url, name):
         user = self.scope['user']  # :type User
         try:
-            room = await s2as(user.create_room)(video_url, name)
-            await self.send(format_message('create_room_success', {
-                'room': await s2as(room.as_dict)()
-            }))
-            await self.notify_all('room_created', {'room': await s2as(room.as_dict)()})
+            room = await s2as(user.create_room, critical=True)(video_url, name)
+            actor = await rooms.create(room, user)
+            await self.leave_current_room()
+            user.room_id = room.pk
+            await self.set_room(room.pk)
+            room = await s2as(RoomSerializer.one)(room)
+            room.update(actor.snapshot())
+            await self.send_frame('create_room_success', {
+                'room': room
+            })
+            await self.notify(topic_group('rooms'), 'room_created', {'room': room})
         except ValueError as err:
-            await self.send(format_message('create_room_error', str(err)))
+            await self.send_frame('create_room_error', str(err))
+
+    async def friend_list(self, user_pks=None):
+        """The min dicts of the friends of the user, or of some users, in the order of their ids"""
+        if user_pks is None: user_pks = await s2as(friend_graph.friends)(self.scope['user'].pk)
+        return await s2as(UserMinSerializer.many)(User.objects.filter(pk__in=user_pks).order_by('pk'))
 
+    @dispatcher.handler('remove_friend', id=ID)
     async def remove_friend(self, id):
         user = self.scope['user']  # :type User
         try:
-            friends = await s2as(user.remove_friend)(id)
-            await self.send(format_message('remove_friend_success', {
-                'friends': [friend.as_min_dict() for friend in friends]
-            }))
+            friend = await s2as(user.remove_friend, critical=True)(id)
+            self.record_friendship(friend.pk)
+            await self.send_frame('remove_friend_success', {
+                'friends': await self.friend_list()
+            })
         except User.DoesNotExist:
-            await self.send(format_message('remove_friend_error', 'User not found'))
+            await self.send_frame('remove_friend_error', 'User not found')
 
+    @dispatcher.handler('add_friend', id=ID)
     async def add_friend(self, id):
         try:
-            friends = await s2as(self.scope['user'].add_friend)(id)
-            await self.send(format_message('add_friend_success', {
-                'friends': await s2as(users_to_dicts)(friends)
-            }))
+            friend = await s2as(self.scope['user'].add_friend, critical=True)(id)
+            self.record_friendship(friend.pk, UserMinSerializer.to_dict(friend))
+            await self.send_frame('add_friend_success', {
+                'friends': await self.friend_list()
+            })
         except User.DoesNotExist:
-            await self.send(format_message('add_friend_error', 'User not found'))
+            await self.send_frame('add_friend_error', 'User not found')
+        except ValueError as err:
+            await self.send_frame('add_friend_error', str(err))
+
+    @dispatcher.handler('mutual_friends', id=ID)
+    @read_only
+    @query_budget(2)
+    async def get_mutual_friends(self, id):
+        mutual = await s2as(friend_graph.mutual)(self.scope['user'].pk, id)
+        await self.send_frame('mutual_friends', {'id': id, 'friends': await self.friend_list(mutual)})
+
+    @dispatcher.handler('suggested_friends', limit=optional(ID))
+    @read_only
+    @query_budget(3)
+    async def get_suggested_friends(self, limit=None):
+        """Friends of friends, the ones with the most friends in common first"""
+        try:
+            limit = page_size(limit)
+        except ValueError as err:
+            return await self.send_frame('suggested_friends_error', str(err))
+        suggestions = await s2as(friend_graph.suggestions)(self.scope['user'].pk, limit)
+        users = {user['id']: user for user in await self.friend_list([pk for pk, _ in suggestions])}
+        await self.send_frame('suggested_friends', {
+            'users': [{**users[pk], 'mutual_friends': count} for pk, count in suggestions if pk in users]
+        })
 
+    @dispatcher.handler('user', id=ID)
+    @read_only
     async def get_user(self, id):
         try:
-            user = await s2as(User.objects.get)(pk=id)
-            user_dict = await s2as(user.as_dict)()
-            await self.send(format_message('user', {'user': user_dict}))
+            user_dict = await s2as(UserSerializer.get)(pk=id)
+            # Emails are only shown to their owner
+            if user_dict['id'] != self.scope['user'].pk: del user_dict['email']
+            await self.send_frame('user', {'user': user_dict})
         except User.DoesNotExist:
-            await self.send(format_message('user', {}))
+            await self.send_frame('user', {})
+
+    @dispatcher.handler('search_users', query=str, cursor=optional(str), limit=optional(ID))
+    @read_only
+    @query_budget(2)
+    async def search_users(self, query, cursor=None, limit=None):
+        """Users by name or email, through the directory rather than sending them all to be filtered by the client"""
+        try:
+            pks, next_cursor = await s2as(user_directory.search)(query, cursor, page_size(limit))
+        except ValueError as err:
+            return await self.send_frame('search_users_error', str(err))
 
-    async def get_users(self):
-        users = await s2as(User.objects.all)()
-        await self.send(format_message('users', {'users': await s2as(users_to_dicts)(users)}))
+        users = {user['id']: user for user in await s2as(UserMinSerializer.many)(User.objects.filter(pk__in=pks))}
+        await self.send_frame('search_users', {
+            'query': query,
+            'users': [users[pk] for pk in pks if pk in users],
+            'next_cursor': next_cursor
+        })
+
+    @dispatcher.handler('users', cursor=optional(str), limit=optional(ID), since=optional(int))
+    @read_only
+    @query_budget(1)
+    async def get_users(self, cursor=None, limit=None, since=None):
+        """The users one page at a time, the version comes with the first page"""
+        delta = change_logs.users.since(since) if since is not None else None
+        if delta is not None:
+            return await self.send_frame('users', {'changes': delta, 'version': change_logs.users.version})
+        # The version is taken before the snapshot, replaying changes it already has is harmless
+        version = change_logs.users.version_before(replica_lag()) if cursor is None else None
+        try:
+            users, next_cursor = await s2as(User.objects.page)(cursor=cursor, limit=page_size(limit))
+        except ValueError as err:
+            return await self.send_frame('users_error', str(err))
+        await self.send_frame('users', {
+            'users': await s2as(UserMinSerializer.many)(users),
+            'next_cursor': next_cursor,
+            'version': version
+        })
 
+    @dispatcher.handler('friends', since=optional(int))
+    @read_only
+    @query_budget(2)
+    async def get_friends(self, since=None):
+        log = change_logs.friends(self.scope['user'].pk)
+        delta = log.since(since) if since is not None else None
+        if delta is not None:
+            return await self.send_frame('friends', {'changes': delta, 'version': log.version})
+        version = log.version_before(replica_lag())
+        friends = await self.friend_list()
+        await self.send_frame('friends', {'friends': friends, 'version': version})
+
+    @dispatcher.handler('profile')
+    @read_only
+    @query_budget(3)
     async def get_profile(self):
         if not self.scope['user'] == AnonymousUser():
-            await self.send(format_message('profile', {'user': await s2as(self.scope['user'].as_dict)()}))
-
-    async def get_rooms(self):
-        rooms = await s2as(Room.objects.order_by)('-created_at')
+            friends_version = change_logs.friends(self.scope['user'].pk).version_before(replica_lag())
+            await self.send_frame('profile', {
+                'user': await s2as(UserSerializer.one)(self.scope['user']),
+                'friends_version': friends_version
+            })
+
+    @dispatcher.handler('rooms', sort=optional(str), cursor=optional(str), limit=optional(ID), since=optional(int))
+    @read_only
+    @query_budget(1)
+    async def get_rooms(self, sort='recent', cursor=None, limit=None, since=None):
+        """
+        A page of rooms, or with `since` the changes of the rooms listed to this connection (in the sort of its pages)
+        and the rooms added on top of them. A connection that hasn't listed any gets the first page.
+        """
+        delta = change_logs.rooms.since(since) if since is not None and self.rooms_sort else None
+        if delta is not None:
+            return await self.send_frame('rooms', {'changes': self.listed_changes(delta),
+                                                   'version': change_logs.rooms.version})
+        # Room changes reach the database a bit later, the snapshot is as of the last write
+        lag = replica_lag()
+        version = rooms.written_version if not lag else \
+            min(rooms.written_version, change_logs.rooms.version_before(lag + rooms.flush_interval))
+        try:
+            page, next_cursor = await s2as(Room.objects.page)(sort=sort, cursor=cursor, limit=page_size(limit))
+        except ValueError as err:
+            return await self.send_frame('rooms_error', str(err))
+
+        if cursor is None or sort != self.rooms_sort: self.rooms_sort, self.listed_rooms = sort, set()
+        self.listed_rooms.update(room.pk for room in page)
+        await self.send_frame('rooms', {
+            'rooms': await s2as(RoomPreviewSerializer.many)(page),
+            'next_cursor': next_cursor,
+            'version': version
+        })
 
-        await self.send(format_message('rooms', {
-            'rooms': await s2as(rooms_to_dicts)(rooms)
-        }))
+    def listed_changes(self, changes):
+        listed = []
+        for change in changes:
+            if change['id'] in self.listed_rooms:
+                if change['op'] == REMOVE: self.listed_rooms.discard(change['id'])
+            elif change['op'] == ADD and self.rooms_sort in Room.objects.NEW_ROOMS_FIRST:
+                self.listed_rooms.add(change['id'])
+            else:
+                continue
+            listed.append(change)
+        return listed
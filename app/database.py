@@ -0,0 +1,99 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .hashing import ServerBusy
+from .metrics import DB_QUEUE_DEPTH, DB_WAIT_SECONDS, DB_CALLS_REFUSED
+
+DATABASE_WORKERS = 8
+DATABASE_QUEUE_LIMIT = 256
+DATABASE_TIMEOUT = 10
+
+
+class DatabaseTimeout(ServerBusy):
+    pass
+
+
+class DatabaseExecutor:
+    """
+    Runs the database calls of the consumers in a pool of `workers` threads, each keeping its own connections,
+    so the calls of different websocket connections run side by side, as many at once as there are threads.
+    Stale and broken connections are closed around every call, like Django does around requests.
+    At most `queue_limit` calls wait for a thread, the next ones are turned away right away, and a call
+    not done after `timeout` seconds gives up (its thread still finishes it, the result is dropped).
+    Critical calls, the writes, are neither turned away nor given up on: a write given up on could still
+    be committed by its thread, and the client told it failed.
+    Sized by the DATABASE_EXECUTOR setting.
+    """
+
+    def __init__(self, workers=None, queue_limit=None, timeout=None):
+        config = getattr(settings, 'DATABASE_EXECUTOR', {})
+        self.workers = workers or config.get('WORKERS', DATABASE_WORKERS)
+        self.queue_limit = queue_limit or config.get('QUEUE_LIMIT', DATABASE_QUEUE_LIMIT)
+        self.timeout = timeout or config.get('TIMEOUT', DATABASE_TIMEOUT)
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='database')
+        return self._pool
+
+    async def run(self, call, critical=False):
+        if not critical and self.waiting >= self.queue_limit:
+            DB_CALLS_REFUSED.inc('busy')
+            raise ServerBusy('The server is busy, try again in a moment')
+        submitted = time.perf_counter()
+        self._queued(1)
+        # The handler's context (its name, query count and replica pin) follows the call into the thread
+        future = self.pool.submit(self._call, submitted, contextvars.copy_context(), call)
+        # Calls cancelled before a thread picked them up never run, they leave the queue here
+        future.add_done_callback(lambda future: future.cancelled() and self._queued(-1))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), None if critical else self.timeout)
+        except asyncio.TimeoutError:
+            DB_CALLS_REFUSED.inc('timeout')
+            raise DatabaseTimeout('The database is taking too long, try again in a moment')
+
+    def _call(self, submitted, context, call):
+        self._queued(-1)
+        DB_WAIT_SECONDS.observe(time.perf_counter() - submitted)
+        close_old_connections()
+        try:
+            return context.run(call)
+        finally:
+            close_old_connections()
+
+    def _queued(self, amount):
+        with self._lock:
+            self.waiting += amount
+        DB_QUEUE_DEPTH.inc(amount=amount)
+
+
+database = DatabaseExecutor()
+
+
+def database_sync_to_async(function, critical=False):
+    """Like sync_to_async, for the functions using the database, run by the database executor"""
+
+    @functools.wraps(function)
+    async def call(*args, **kwargs):
+        return await database.run(functools.partial(function, *args, **kwargs), critical)
+
+    return call
+
+
+def background(coroutine):
+    """
+    Run a coroutine in a task of its own, like ensure_future, but without the context of the caller:
+    the writes it makes are not counted against the handler that happened to start it, nor pin its connection.
+    """
+    return contextvars.Context().run(asyncio.ensure_future, coroutine)
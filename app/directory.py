@@ -0,0 +1,176 @@
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from datetime import timedelta
+from itertools import chain, islice
+
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from .models import User
+from .pagination import DEFAULT_PAGE_SIZE, encode_cursor, decode_cursor
+
+DIRECTORY_REFRESH = 5
+SEARCH_QUERY_MAX_LENGTH = 100
+TRIGRAM_MIN_LENGTH = 3
+
+
+def normalize(text):
+    """Lowercase, without accents and with single spaces, what names and queries are compared as"""
+    text = unicodedata.normalize('NFKD', text)
+    return ' '.join(''.join(char for char in text if not unicodedata.combining(char)).casefold().split())
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SortedTerms:
+    """(term, pk) pairs kept sorted, so the pks of the terms starting with a prefix are a slice"""
+
+    def __init__(self):
+        self._pairs = []
+
+    def add(self, term, pk):
+        insort(self._pairs, (term, pk))
+
+    def remove(self, term, pk):
+        i = bisect_left(self._pairs, (term, pk))
+        if i < len(self._pairs) and self._pairs[i] == (term, pk): del self._pairs[i]
+
+    def starting_with(self, prefix):
+        for term, pk in islice(self._pairs, bisect_left(self._pairs, (prefix,)), None):
+            if not term.startswith(prefix): return
+            yield pk
+
+
+class UserDirectory:
+    """
+    An index of the names and emails of the users, for `search_users`.
+    Matches are ranked: names starting with the query (the exact name first), then names with a word
+    starting with it, then the user with that exact email, then names containing it (found through their trigrams).
+    It is loaded on the first search and kept up to date by the saves of this process,
+    the users who signed up or changed their name or email through other processes are picked up
+    every DIRECTORY_REFRESH seconds, by their `updated_at`.
+    """
+
+    def __init__(self, refresh=DIRECTORY_REFRESH):
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Empty the directory, it loads again on the next search"""
+        self.loaded = False
+        self._updated_since = None
+        self._refreshed_at = 0.0
+        self._entries = {}  # pk -> (name, words, email)
+        self._names = SortedTerms()
+        self._words = SortedTerms()
+        self._emails = {}  # email -> pk, only found whole so that an address can't be guessed a letter at a time
+        self._trigrams = {}  # trigram -> pks of the names containing it
+
+    def search(self, query, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """One page of the pks of the users matching the query, best matches first, and the cursor of the next"""
+        query = normalize(query)
+        if not query: raise ValueError('You must provide something to search for')
+        if len(query) > SEARCH_QUERY_MAX_LENGTH: raise ValueError('The search is too long')
+        offset = decode_cursor(cursor, User, ('offset',))[0] if cursor else 0
+        if not isinstance(offset, int) or offset < 0: raise ValueError('Invalid cursor')
+
+        self._update()
+        with self._lock:
+            matches = chain(self._names.starting_with(query), self._words.starting_with(query),
+                            self._with_email(query), self._containing(query))
+            pks = list(islice(unique(matches), offset, offset + limit + 1))
+        if len(pks) <= limit: return pks, None
+        return pks[:limit], encode_cursor([offset + limit])
+
+    def index(self, user):
+        with self._lock:
+            self._index(user.pk, user.name, user.email)
+
+    def remove(self, user_pk):
+        with self._lock:
+            self._remove(user_pk)
+
+    def _with_email(self, query):
+        if query in self._emails: yield self._emails[query]
+
+    def _containing(self, query):
+        if len(query) < TRIGRAM_MIN_LENGTH: return
+        candidates = set.intersection(*[self._trigrams.get(trigram, set()) for trigram in trigrams(query)])
+        # Trigrams can match out of order, the names themselves tell
+        yield from sorted(pk for pk in candidates if query in self._entries[pk][0])
+
+    def _update(self):
+        """Load the directory, or the users saved since it was last refreshed"""
+        if self.loaded and time.monotonic() - self._refreshed_at < self.refresh: return
+        self._refreshed_at = time.monotonic()
+        started = timezone.now()
+        users = User.objects.values_list('pk', 'name', 'email')
+        if self._updated_since is not None: users = users.filter(updated_at__gte=self._updated_since)
+        users = list(users)
+        with self._lock:
+            for pk, name, email in users:
+                self._index(pk, name, email)
+            # Going back a refresh covers the saves committed late and the clocks of the other servers
+            self._updated_since = started - timedelta(seconds=self.refresh)
+            self.loaded = True
+
+    def _index(self, pk, name, email):
+        entry = self._entries.get(pk)
+        # Most saves (logging in) change neither
+        if entry is not None and entry[0] == normalize(name) and entry[2] == normalize(email): return
+        self._remove(pk)
+        self._add(pk, name, email)
+
+    def _add(self, pk, name, email):
+        name, email = normalize(name), normalize(email)
+        words = re.findall(r'\w+', name)
+        self._entries[pk] = (name, words, email)
+        self._names.add(name, pk)
+        self._emails[email] = pk
+        for word in set(words):
+            self._words.add(word, pk)
+        for trigram in trigrams(name):
+            self._trigrams.setdefault(trigram, set()).add(pk)
+
+    def _remove(self, pk):
+        entry = self._entries.pop(pk, None)
+        if entry is None: return
+        name, words, email = entry
+        self._names.remove(name, pk)
+        if self._emails.get(email) == pk: del self._emails[email]
+        for word in set(words):
+            self._words.remove(word, pk)
+        for trigram in trigrams(name):
+            pks = self._trigrams[trigram]
+            pks.discard(pk)
+            if not pks: del self._trigrams[trigram]
+
+
+def unique(pks):
+    seen = set()
+    for pk in pks:
+        if pk in seen: continue
+        seen.add(pk)
+        yield pk
+
+
+user_directory = UserDirectory()
+
+
+def index_user(sender, instance, **kwargs):
+    # Until the first search the directory is empty, the users will be there when it loads
+    if user_directory.loaded: user_directory.index(instance)
+
+
+def remove_user(sender, instance, **kwargs):
+    user_directory.remove(instance.pk)
+
+
+post_save.connect(index_user, sender=User)
+post_delete.connect(remove_user, sender=User)
@@ -0,0 +1,254 @@
+import logging
+import time
+
+from django.conf import settings
+
+from .hashing import ServerBusy
+from .metrics import current_handler, current_queries, CONNECTIONS, MESSAGES, HANDLER_SECONDS, HANDLER_ERRORS, \
+    GROUP_DELIVERIES, SENT_FRAMES, SENT_BYTES
+from .protocol import JSON, MSGPACK, format_message, format_message_reverse, format_message_binary, \
+    format_message_binary_reverse, binary_frame, negotiate
+from .routers import current_pin, current_read_only, Pin
+
+logger = logging.getLogger(__name__)
+
+
+class field:
+    """
+    A payload field, `key` is its name in the payload when it differs from the handler argument.
+    `types` is a type or a tuple of them, or a function turning the value into the argument (raising ValueError).
+    """
+
+    def __init__(self, types, required=True, key=None):
+        self.parse = types if callable(types) and not isinstance(types, type) else None
+        self.types = types if isinstance(types, tuple) or self.parse else (types,)
+        self.required = required
+        self.key = key
+
+
+def optional(types, key=None):
+    return field(types, required=False, key=key)
+
+
+def parse_id(value):
+    # Clients send ids as numbers or as numeric strings, bool is an int for isinstance
+    if isinstance(value, str) and value.isdigit(): value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1: raise ValueError('Invalid id')
+    return value
+
+
+ID = parse_id
+NUMBER = (int, float)
+
+
+class InvalidPayload(ValueError):
+    pass
+
+
+def compile_schema(schema):
+    """Turn {argument: type or field} into a function checking a payload and returning the handler kwargs"""
+    fields = []
+    for name, spec in schema.items():
+        if not isinstance(spec, field): spec = field(spec)
+        fields.append((name, spec.key or name, spec.types, spec.parse, spec.required,
+                       not spec.parse and bool in spec.types))
+
+    def validate(data):
+        if data is None: data = {}
+        if not isinstance(data, dict): raise InvalidPayload('The data of the message must be an object')
+        kwargs = {}
+        for name, key, types, parse, required, allows_bool in fields:
+            value = data.get(key)
+            if value is None:
+                if required: raise InvalidPayload(f'The field {key} is required')
+                continue
+            if parse is not None:
+                try:
+                    value = parse(value)
+                except ValueError:
+                    raise InvalidPayload(f'The field {key} is invalid')
+            # bool is an int for isinstance, don't take true for a number
+            elif not isinstance(value, types) or (isinstance(value, bool) and not allows_bool):
+                raise InvalidPayload(f'The field {key} is invalid')
+            kwargs[name] = value
+        return kwargs
+
+    return validate
+
+
+def query_budget(queries):
+    """The most database queries a handler may make, checked in DEBUG and by the tests"""
+
+    def decorate(function):
+        function.query_budget = queries
+        return function
+
+    return decorate
+
+
+def read_only(function):
+    """Marks a handler that only reads, its queries go to the read replica when there is one"""
+    function.read_only = True
+    return function
+
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.max_queries = None  # only known when the query budgets are checked
+
+    def observe(self, duration, failed=False, queries=None):
+        self.calls += 1
+        if failed: self.errors += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        if queries is not None: self.max_queries = max(self.max_queries or 0, queries)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'average_time': self.total_time / self.calls if self.calls else 0.0,
+            'max_time': self.max_time,
+            'max_queries': self.max_queries
+        }
+
+
+class Dispatcher:
+    """
+    Maps message types to consumer handlers and checks their payloads.
+    Handlers are registered with the `handler` decorator and get the payload fields as keyword arguments.
+    """
+    instances = []  # every dispatcher, for the metrics of their handlers
+
+    def __init__(self):
+        Dispatcher.instances.append(self)
+        self.handlers = {}
+        self.stats = {}
+        self.budgets = {}
+        self.read_only = set()
+
+    def handler(self, type, **schema):
+        validate = compile_schema(schema)
+
+        def register(function):
+            self.handlers[type] = (function, validate)
+            self.stats[type] = HandlerStats()
+            if hasattr(function, 'query_budget'): self.budgets[type] = function.query_budget
+            if getattr(function, 'read_only', False): self.read_only.add(type)
+            return function
+
+        return register
+
+    async def dispatch(self, consumer, type, data):
+        entry = self.handlers.get(type)
+        if entry is None:
+            # Types sent by clients are not used as labels unless they have a handler
+            MESSAGES.inc('unknown')
+            return await consumer.send_frame('error', f'Unknown message type {type}')
+
+        MESSAGES.inc(type)
+        function, validate = entry
+        start = time.perf_counter()
+        try:
+            kwargs = validate(data)
+        except InvalidPayload as err:
+            self.observe(type, time.perf_counter() - start, failed=True)
+            return await consumer.send_frame(f'{type}_error', str(err))
+
+        token = current_handler.set(type)
+        queries = [0] if settings.DEBUG and type in self.budgets else None
+        queries_token = current_queries.set(queries)
+        pin_token = current_pin.set(consumer.db_pin)
+        read_only_token = current_read_only.set(type in self.read_only)
+        try:
+            await function(consumer, **kwargs)
+        except ServerBusy as err:
+            self.observe(type, time.perf_counter() - start, failed=True)
+            return await consumer.send_frame(f'{type}_error', str(err))
+        except Exception:
+            self.observe(type, time.perf_counter() - start, failed=True)
+            logger.exception('The %s handler failed', type)
+            return await consumer.send_frame(f'{type}_error', 'Something went wrong')
+        finally:
+            current_handler.reset(token)
+            current_queries.reset(queries_token)
+            current_pin.reset(pin_token)
+            current_read_only.reset(read_only_token)
+        self.observe(type, time.perf_counter() - start, queries=queries and queries[0])
+
+    def observe(self, type, duration, failed=False, queries=None):
+        self.stats[type].observe(duration, failed, queries)
+        HANDLER_SECONDS.observe(duration, type)
+        if failed: HANDLER_ERRORS.inc(type)
+        if queries is not None and queries > self.budgets[type]:
+            logger.warning('The %s handler made %d queries, its budget is %d', type, queries, self.budgets[type])
+
+    def stats_dict(self):
+        return {type: stats.as_dict() for type, stats in self.stats.items()}
+
+
+class DispatchMixin:
+    """
+    Gives a consumer a `receive` that routes messages through its `dispatcher`.
+    The wire protocol is picked when the connection is accepted: JSON in text frames by default,
+    MessagePack in binary frames for clients asking for the `msgpack` subprotocol or `?protocol=msgpack`.
+    """
+    dispatcher = None
+    protocol = JSON
+    counted = False
+    db_pin = None
+
+    async def websocket_connect(self, message):
+        self.db_pin = Pin()
+        await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None):
+        self.protocol, subprotocol = negotiate(self.scope.get('subprotocols', ()), self.scope.get('query_string', b''))
+        await super().accept(subprotocol)
+        CONNECTIONS.inc(type(self).__name__)
+        self.counted = True
+        self.sent_frames, self.sent_bytes = SENT_FRAMES.labels(self.protocol), SENT_BYTES.labels(self.protocol)
+
+    async def websocket_disconnect(self, message):
+        if self.counted:
+            CONNECTIONS.dec(type(self).__name__)
+            self.counted = False
+        await super().websocket_disconnect(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if bytes_data is not None:
+                type, data = format_message_binary_reverse(bytes_data)
+            else:
+                type, data = format_message_reverse(text_data)
+        except (TypeError, ValueError, AttributeError):
+            return await self.send_frame('error', 'Invalid message')
+        # The type is looked up in the handlers, a list or an object can't be
+        if not isinstance(type, str): return await self.send_frame('error', 'Invalid message')
+        await self.dispatcher.dispatch(self, type, data)
+
+    async def send_frame(self, type, data):
+        if self.protocol == MSGPACK:
+            await self.send_encoded(bytes_data=format_message_binary(type, data))
+        else:
+            await self.send_encoded(text_data=format_message(type, data))
+
+    async def websocket_send(self, message):
+        """Forward a group message, encoded once by the sender (JSON) or once per process (MessagePack)"""
+        GROUP_DELIVERIES.inc(message.get('frame', 'unknown'))
+        if self.protocol == MSGPACK:
+            await self.send_encoded(bytes_data=binary_frame(message['text']))
+        else:
+            await self.send_encoded(text_data=message['text'])
+
+    async def send_encoded(self, text_data=None, bytes_data=None):
+        frame = text_data if bytes_data is None else bytes_data
+        if self.counted:
+            self.sent_frames.inc()
+            # JSON frames are ASCII, their length is their size in bytes
+            self.sent_bytes.inc(len(frame))
+        await self.send(text_data=text_data, bytes_data=bytes_data)
@@ -0,0 +1,101 @@
+import heapq
+import threading
+import time
+from collections import Counter, OrderedDict
+from itertools import chain
+
+from .models import User
+
+FRIEND_GRAPH_SIZE = 100000
+FRIEND_GRAPH_TTL = 60
+FRIEND_SUGGESTIONS = 10
+
+
+class FriendGraph:
+    """
+    The friends of the users, as sets of pks kept in memory so friends, mutual friends and suggestions
+    are answered without going through the friendships table every time.
+    Friendships made here update the sets right away. The graph is per process like the token cache,
+    friendships made by other processes are seen once the sets of their users expire.
+    """
+
+    def __init__(self, max_size=FRIEND_GRAPH_SIZE, ttl=FRIEND_GRAPH_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._friends = OrderedDict()  # user pk -> (friend pks, expiry time)
+        # Bumped by every change, loads that raced with one are not kept
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def friends_of(self, user_pks):
+        """The friend pks of each user, the users the graph doesn't have are loaded in one query"""
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for user_pk in user_pks:
+                entry = self._friends.get(user_pk)
+                if entry is None or entry[1] <= now:
+                    missing.append(user_pk)
+                    continue
+                self._friends.move_to_end(user_pk)
+                found[user_pk] = entry[0]
+            generation = self._generation
+        if missing: found.update(self._load(missing, generation))
+        return found
+
+    def friends(self, user_pk):
+        return self.friends_of((user_pk,))[user_pk]
+
+    def mutual(self, user_pk, other_pk):
+        friends = self.friends_of((user_pk, other_pk))
+        return friends[user_pk] & friends[other_pk]
+
+    def suggestions(self, user_pk, limit=FRIEND_SUGGESTIONS):
+        """The friends of friends who aren't friends yet, with the number of friends they have in common, most first"""
+        friends = self.friends(user_pk)
+        overlap = Counter(chain.from_iterable(self.friends_of(friends).values()))
+        for pk in friends | {user_pk}:
+            overlap.pop(pk, None)
+        # Ties go to the oldest users, with plain tuples rather than a key function for speed
+        return [(pk, -count) for count, pk in heapq.nsmallest(limit, ((-count, pk) for pk, count in overlap.items()))]
+
+    def add(self, user_pk, friend_pk):
+        self._change(user_pk, friend_pk, frozenset.union)
+
+    def remove(self, user_pk, friend_pk):
+        self._change(user_pk, friend_pk, frozenset.difference)
+
+    def clear(self):
+        with self._lock:
+            self._friends.clear()
+            self._generation += 1
+
+    def _change(self, user_pk, friend_pk, operation):
+        # Friendships go both ways, the users not in the graph get the change when they are loaded
+        with self._lock:
+            self._generation += 1
+            for pk, other in ((user_pk, friend_pk), (friend_pk, user_pk)):
+                entry = self._friends.get(pk)
+                if entry is not None: self._friends[pk] = (operation(entry[0], (other,)), entry[1])
+
+    def _load(self, user_pks, generation):
+        Friendship = User.friends.through
+        loaded = {pk: set() for pk in user_pks}
+        rows = Friendship.objects.filter(from_user_id__in=user_pks).values_list('from_user_id', 'to_user_id')
+        for from_pk, to_pk in rows:
+            loaded[from_pk].add(to_pk)
+        loaded = {pk: frozenset(friends) for pk, friends in loaded.items()}
+
+        with self._lock:
+            # A friendship changed while loading, the sets may be missing it, serve them but don't keep them
+            if generation != self._generation: return loaded
+            expires_at = time.monotonic() + self.ttl
+            for pk, friends in loaded.items():
+                self._friends[pk] = (friends, expires_at)
+                self._friends.move_to_end(pk)
+            while len(self._friends) > self.max_size:
+                self._friends.popitem(last=False)
+        return loaded
+
+
+friend_graph = FriendGraph()
@@ -0,0 +1,17 @@
+TOPICS = ('rooms',)
+
+
+def user_group(user_pk):
+    """The group every connection of a user is in"""
+    return f'user.{user_pk}'
+
+
+def room_group(room_pk):
+    """The group of the connections watching a room"""
+    return f'room.{room_pk}'
+
+
+def topic_group(topic):
+    """The group of the connections that subscribed to a topic, e.g. `rooms` for the rooms list"""
+    if topic not in TOPICS: raise ValueError(f'Unknown topic {topic}')
+    return f'topic.{topic}'
@@ -0,0 +1,57 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.contrib.auth.hashers import make_password, check_password
+
+HASHING_WORKERS = 2
+HASHING_QUEUE_LIMIT = 32
+
+
+class ServerBusy(Exception):
+    pass
+
+
+class PasswordHashing:
+    """
+    Hashes and checks passwords in a pool of processes, so a burst of logins doesn't hold
+    the threads running the database calls of every other consumer.
+    At most `queue_limit` passwords wait for the pool, the next ones are turned away right away.
+    """
+
+    def __init__(self, workers=HASHING_WORKERS, queue_limit=HASHING_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # Spawned rather than forked, forking a process running threads can copy locks held by them
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=django.setup)
+        return self._pool
+
+    async def _run(self, function, *args):
+        if self.pending >= self.queue_limit: raise ServerBusy('The server is busy, try again in a moment')
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.pool, function, *args)
+        except BrokenProcessPool:
+            # A worker died, start a new pool for the next passwords
+            self._pool = None
+            raise ServerBusy('The server is busy, try again in a moment')
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        return await self._run(make_password, password)
+
+    async def check(self, password, encoded):
+        return await self._run(check_password, password, encoded)
+
+
+password_hashing = PasswordHashing()
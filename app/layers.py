@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import logging
+import time
+from bisect import bisect
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+from .metrics import GROUP_FANOUT, LAYER_DELIVERIES
+
+logger = logging.getLogger(__name__)
+
+HASH_RING_POINTS = 160
+
+# channels_redis' group send script: pushes a message to each key that isn't full, returns how many were
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    for i=1,#KEYS do
+        if redis.call('LLEN', KEYS[i]) < tonumber(ARGV[i + #KEYS]) then
+            redis.call('LPUSH', KEYS[i], ARGV[i])
+            redis.call('EXPIRE', KEYS[i], %d)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+# Drops the expired members of a group and returns the others, in one round trip
+GROUP_MEMBERS_LUA = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+    return redis.call('ZRANGE', KEYS[1], 0, -1)
+"""
+
+
+def ring_hash(value):
+    if isinstance(value, str): value = value.encode('utf8')
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of names onto shards, each shard owning HASH_RING_POINTS points of the ring.
+    Adding or removing a shard only moves the names of its share of the ring, the others stay where they are.
+    """
+
+    def __init__(self, shards, points=HASH_RING_POINTS):
+        ring = sorted((ring_hash(f'{shard}#{point}'), index) for index, shard in enumerate(shards)
+                      for point in range(points))
+        self._hashes = [value for value, _ in ring]
+        self._shards = [index for _, index in ring]
+
+    def shard(self, name):
+        return self._shards[bisect(self._hashes, ring_hash(name)) % len(self._hashes)]
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """
+    A Redis channel layer that delivers to the channels of its own process without going through Redis,
+    only what is sent to the consumers of other processes goes through it, and one reader per process
+    moves what they receive that way into the buffers of their channels.
+    Groups are still kept in Redis, a group send reads its members in one round trip
+    and pushes only the remote ones. The groups and channels are spread over the shards (`hosts`)
+    with a hash ring rather than channels_redis' modulo, so adding a shard doesn't move all of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Keyed by address, so every process maps the names the same way whatever the order of the hosts
+        self.ring = HashRing([str(host['address']) for host in self.hosts])
+        # The specific channels of the consumers running in this process
+        self.local_channels = set()
+        self.readers = {}  # the name of the Redis list of the specific channels of this process -> its reader
+        self.group_send_lua = GROUP_SEND_LUA % self.expiry
+        self.local_deliveries = LAYER_DELIVERIES.labels('local')
+        self.remote_deliveries = LAYER_DELIVERIES.labels('redis')
+        self.fanout = GROUP_FANOUT.labels()
+
+    def consistent_hash(self, value):
+        # The specific channels of a process share one Redis list, channels_redis' send hashes their full name
+        # but the receiving end hashes the list's, hashing up to the `!` sends them where they are read
+        if '!' in value: value = value[:value.index('!') + 1]
+        return self.ring.shard(value)
+
+    async def new_channel(self, prefix='specific'):
+        channel = await super().new_channel(prefix)
+        self.local_channels.add(channel)
+        return channel
+
+    async def receive(self, channel):
+        """
+        Wait for the next message of a channel. The ones of the channels of this process are put in their
+        buffer, by the local senders or by a reader moving what other processes sent through Redis.
+        """
+        if '!' not in channel: return await super().receive(channel)
+        if channel not in self.local_channels: raise ValueError(f'{channel} is not a channel of this process')
+        self.start_reader(self.non_local_name(channel))
+        buffer = self.receive_buffer[channel]
+        try:
+            return await buffer.get()
+        except asyncio.CancelledError:
+            # Consumers stop by cancelling their receive, the channel is gone
+            self.local_channels.discard(channel)
+            self.receive_buffer.pop(channel, None)
+            if not self.local_channels: self.stop_readers()
+            raise
+
+    def start_reader(self, real_channel):
+        loop = asyncio.get_event_loop()
+        reader = self.readers.get(real_channel)
+        if reader is not None and not reader.done():
+            if self.receive_event_loop is not loop:
+                raise RuntimeError('Two event loops are trying to receive() on one channel layer at once!')
+            return
+        self.receive_event_loop = loop
+        self.readers[real_channel] = loop.create_task(self.read(real_channel))
+
+    def stop_readers(self):
+        for reader in self.readers.values():
+            reader.cancel()
+        self.readers.clear()
+
+    async def read(self, real_channel):
+        """Move the messages sent to this process through Redis to the buffers of their channels"""
+        while True:
+            try:
+                channels, message = await self.receive_single(real_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Could not read the messages of %s from Redis', real_channel)
+                await asyncio.sleep(1)
+                continue
+            for channel in channels if isinstance(channels, list) else [channels]:
+                # Messages for consumers that have stopped are dropped, like Redis would let them expire
+                if channel not in self.local_channels: continue
+                try:
+                    self.deliver(channel, message, counted=False)
+                except ChannelFull:
+                    logger.warning('Channel %s is over capacity, a message was dropped', channel)
+
+    def is_local(self, channel):
+        # The buffers belong to the loop receiving, other loops (async_to_sync) go through Redis
+        return channel in self.local_channels and self.receive_event_loop is asyncio.get_event_loop()
+
+    def deliver(self, channel, message, counted=True):
+        buffer = self.receive_buffer[channel]
+        if buffer.qsize() >= self.get_capacity(channel): raise ChannelFull()
+        # Each recipient gets its own copy, like the ones Redis deserializes
+        buffer.put_nowait(dict(message))
+        if counted: self.local_deliveries.inc()
+
+    async def send(self, channel, message):
+        if self.is_local(channel): return self.deliver(channel, message)
+        await super().send(channel, message)
+        self.remote_deliveries.inc()
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Group name not valid'
+        key = self._group_key(group)
+        async with self.connection(self.consistent_hash(group)) as connection:
+            expired = int(time.time()) - self.group_expiry
+            members = await connection.eval(GROUP_MEMBERS_LUA, keys=[key], args=[expired])
+        self.fanout.observe(len(members))
+
+        remote, over_capacity = [], 0
+        for channel in members:
+            channel = channel.decode('utf8')
+            if not self.is_local(channel):
+                remote.append(channel)
+                continue
+            try:
+                self.deliver(channel, message)
+            except ChannelFull:
+                over_capacity += 1
+        if remote: over_capacity += await self.send_remote(remote, message)
+        if over_capacity:
+            logger.warning('%d of %d channels over capacity in group %s', over_capacity, len(members), group)
+
+    async def send_remote(self, channels, message):
+        """Push a group message to channels of other processes, one script per shard, returns how many were full"""
+        channel_keys, messages, capacities = self._map_channel_keys_to_connection(channels, message)
+        over_capacity = 0
+        for index, keys in channel_keys.items():
+            args = [messages[key] for key in keys] + [capacities[key] for key in keys]
+            async with self.connection(index) as connection:
+                over_capacity += await connection.eval(self.group_send_lua, keys=keys, args=args)
+        self.remote_deliveries.inc(len(channels))
+        return over_capacity
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.consumers import GlobalConsumer
+from app.protocol import MSGPACK, binary_frame, format_message, format_message_reverse, group_frame
+
+
+def room_data(messages):
+    author = {'name': 'Anonymous', 'is_online': True, 'id': 1}
+    return {'room': {
+        'name': 'Movie night',
+        'users_watching': [author] * 10,
+        'user': author,
+        'messages': [{
+            'message_text': 'a chat message of a reasonable length, with some words in it',
+            'created_at': '2020-03-30T14:08:00.000000+00:00',
+            'author': author,
+            'id': i
+        } for i in range(messages)],
+        'messages_cursor': None,
+        'id': 1
+    }}
+
+
+class Command(BaseCommand):
+    help = 'Measure the CPU spent per recipient when a group message is delivered to many connections'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=10000)
+        parser.add_argument('--messages', type=int, default=50, help='Chat messages in the broadcast room')
+
+    def handle(self, *args, **options):
+        recipients = options['recipients']
+        message = group_frame('room_created', room_data(options['messages']))
+
+        async def send(text_data=None, bytes_data=None):
+            pass
+
+        consumer = GlobalConsumer({'type': 'websocket'})
+        consumer.send = send
+        binary_consumer = GlobalConsumer({'type': 'websocket'})
+        binary_consumer.send = send
+        binary_consumer.protocol = MSGPACK
+
+        async def before():
+            # What websocket_send used to do: decode and encode again for every recipient
+            for _ in range(recipients):
+                type, data = format_message_reverse(message['text'])
+                await send(format_message(type, data))
+
+        async def after():
+            for _ in range(recipients):
+                await consumer.websocket_send(message)
+
+        async def after_binary():
+            for _ in range(recipients):
+                await binary_consumer.websocket_send(message)
+
+        results = {
+            'recipients': recipients,
+            'frame_bytes': len(message['text'].encode('utf-8')),
+            'binary_frame_bytes': len(binary_frame(message['text']))
+        }
+        for name, run in (('before', before), ('after', after), ('after_binary', after_binary)):
+            start = time.process_time()
+            asyncio.run(run())
+            results[f'{name}_us_per_recipient'] = (time.process_time() - start) / recipients * 1e6
+        self.stdout.write(json.dumps(results))
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import math
+import random
+import time
+from collections import defaultdict
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from app.chat import chat
+from app.metrics import current_handler
+from app.protocol import format_message, format_message_reverse
+from app.rooms import rooms
+from app.routing import application
+
+# message type -> weight in the traffic of a connected client
+TRAFFIC_MIX = {
+    'send_message': 40,
+    'rooms': 10,
+    'users': 10,
+    'room_history': 10,
+    'get_posts': 10,
+    'profile': 5,
+    'create_post': 5,
+    'play': 5,
+    'join_room': 5
+}
+# message type -> the reply ending its round trip, besides `<type>_error`
+REPLIES = {
+    'signup': 'signup_success',
+    'login': 'login_success',
+    'create_room': 'create_room_success',
+    'join_room': 'join_room_success',
+    'send_message': 'send_message_success',
+    'rooms': 'rooms',
+    'users': 'users',
+    'room_history': 'room_history',
+    'get_posts': 'posts',
+    'profile': 'profile',
+    'create_post': 'create_post_success',
+    'play': 'playback'
+}
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of sorted values"""
+    if not values: return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+class QueryCounter:
+    """Counts the queries of every database connection by the message type being handled"""
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def __call__(self, execute, sql, params, many, context):
+        self.counts[current_handler.get() or 'other'] += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers: connection.execute_wrappers.append(self)
+
+
+class Client:
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.index = index
+        self.email = f'bench{index}@example.com'
+        self.password = 'benchmark'
+        self.token = None
+        self.room = None
+        self.communicator = None
+
+    async def request(self, communicator, type, data=None):
+        """Send a message and wait for its reply, frames pushed in the meantime are skipped"""
+        replies = (REPLIES[type], f'{type}_error')
+        start = time.perf_counter()
+        await communicator.send_to(text_data=format_message(type, data))
+        while True:
+            reply_type, reply = format_message_reverse(await communicator.receive_from(self.bench.timeout))
+            if reply_type in replies: break
+        self.bench.observe(type, time.perf_counter() - start, failed=reply_type != replies[0])
+        return reply if reply_type == replies[0] else None
+
+    async def authenticate(self):
+        communicator = WebsocketCommunicator(application, '/auth')
+        await communicator.connect()
+        await self.request(communicator, 'signup', {'email': self.email, 'name': f'Bench {self.index}',
+                                                    'password': self.password})
+        reply = await self.request(communicator, 'login', {'email': self.email, 'password': self.password})
+        await communicator.disconnect()
+        self.token = reply['token']
+
+    async def connect(self):
+        self.communicator = WebsocketCommunicator(application, '/' + self.token)
+        await self.communicator.connect()
+        while format_message_reverse(await self.communicator.receive_from(self.bench.timeout))[0] != 'profile':
+            pass
+
+    async def create_room(self):
+        reply = await self.request(self.communicator, 'create_room', {'videoURL': 'https://example.com/video',
+                                                                      'name': f'Room {self.index}'})
+        self.room = reply['room']['id']
+
+    async def join_room(self, room):
+        if await self.request(self.communicator, 'join_room', {'id': room}): self.room = room
+
+    async def run(self, rounds, rng):
+        types, weights = zip(*TRAFFIC_MIX.items())
+        for type in rng.choices(types, weights, k=rounds):
+            if type == 'send_message':
+                data = {'message': f'message from client {self.index}'}
+            elif type == 'room_history' or type == 'join_room':
+                data = {'id': self.room}
+            elif type == 'create_post':
+                data = {'post': f'post from client {self.index}'}
+            elif type == 'play':
+                data = {'position': rng.uniform(0, 600)}
+            else:
+                data = None
+            await self.request(self.communicator, type, data)
+
+
+class Command(BaseCommand):
+    help = 'Drive simulated clients through the websocket consumers and report the latency and queries per message type'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=20)
+        parser.add_argument('--rounds', type=int, default=50, help='Messages sent by every connected client')
+        parser.add_argument('--clients-per-room', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--timeout', type=float, default=10)
+        parser.add_argument('--fast-hashing', action='store_true', help='Hash the passwords with MD5')
+
+    def observe(self, type, duration, failed=False):
+        self.latencies[type].append(duration)
+        if failed: self.errors[type] += 1
+
+    def handle(self, *args, **options):
+        self.timeout = options['timeout']
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.queries = QueryCounter()
+
+        overrides = {'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}}
+        if options['fast_hashing']:
+            overrides['PASSWORD_HASHERS'] = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+        # Run against a throwaway database, like the tests
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        # and so does the replica, if there is one
+        for alias in connections:
+            if connections[alias].settings_dict['TEST'].get('MIRROR') == connection.alias:
+                connections[alias].creation.set_as_test_mirror(connection.settings_dict)
+        connection_created.connect(self.queries.install)
+        self.queries.install(connection)
+        try:
+            with override_settings(**overrides):
+                results = asyncio.run(self.run(options))
+        finally:
+            connection_created.disconnect(self.queries.install)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+
+    async def run(self, options):
+        clients = [Client(self, index) for index in range(options['clients'])]
+        start = time.perf_counter()
+        await asyncio.gather(*[client.authenticate() for client in clients])
+        await asyncio.gather(*[client.connect() for client in clients])
+
+        owners = clients[::options['clients_per_room']]
+        await asyncio.gather(*[client.create_room() for client in owners])
+        await asyncio.gather(*[client.join_room(owners[i // options['clients_per_room']].room)
+                               for i, client in enumerate(clients) if client not in owners])
+        setup_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client.run(options['rounds'], random.Random(options['seed'] * 100003 + client.index))
+                               for client in clients])
+        traffic_time = time.perf_counter() - start
+
+        await asyncio.gather(*[client.communicator.disconnect() for client in clients])
+        await chat.flush()
+        await rooms.flush()
+
+        messages = {}
+        for type, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            messages[type] = {
+                'count': len(latencies),
+                'errors': self.errors[type],
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'queries_per_message': self.queries.counts[type] / len(latencies)
+            }
+        traffic_messages = len(clients) * options['rounds']
+        return {
+            'clients': len(clients),
+            'rounds': options['rounds'],
+            'seed': options['seed'],
+            'setup_seconds': setup_time,
+            'traffic_seconds': traffic_time,
+            'messages_per_second': traffic_messages / traffic_time if traffic_time else None,
+            'queries_outside_handlers': self.queries.counts['other'],
+            'messages': messages
+        }
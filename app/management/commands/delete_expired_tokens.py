@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.models import Token
+
+
+class Command(BaseCommand):
+    help = 'Delete the tokens that have expired, to be run periodically (from cron for instance)'
+
+    def handle(self, *args, **options):
+        deleted, _ = Token.objects.delete_expired()
+        self.stdout.write(f'Deleted {deleted} expired tokens')
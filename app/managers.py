@@ -1,19 +1,35 @@
 import re
 import jwt
-import json
+import hashlib
+import time
+from datetime import timedelta
+from uuid import uuid4
 
 JWT_SECRET = '}Ù4651┤74'
 JWT_ALGORITHM = 'HS256'
+TOKEN_LIFETIME = timedelta(days=30)
 
 from django.contrib.auth.models import BaseUserManager
 from django.contrib.auth.hashers import check_password
+from django.db import models
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .pagination import keyset_paginate, DEFAULT_PAGE_SIZE
+from .token_cache import token_cache
+
+
+def token_key(token):
+    """The id a token is stored under, tokens themselves are never stored"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
 
 
 class UserManager(BaseUserManager):
     """The manager of the User class"""
 
-    def create_user(self, email=None, name='Anonymous', password=None, gender='male'):
-        """Create a new User"""
+    def validate_user(self, email=None, password=None, gender='male'):
+        """Check the fields of a new User, before paying for hashing its password"""
         email_regex = r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)"
         if not email: raise ValueError('A user must have an email')
         if not re.fullmatch(email_regex, email): raise ValueError('Invalid Email')
@@ -22,11 +38,18 @@ class UserManager(BaseUserManager):
         if not (gender == 'male' or gender == 'female'):
             raise ValueError('The gender must be either male or female')
 
+    def create_user(self, email=None, name='Anonymous', password=None, gender='male', password_hash=None):
+        """Create a new User, `password_hash` is `password` already hashed"""
+        self.validate_user(email, password, gender)
+
         avatar = f'https://robohash.org/{email}/?set=set4&size=1000x1000'
         preview_avatar = f'https://robohash.org/{email}/?set=set4&size=350x350'
         email = self.normalize_email(email)
         user = self.model(name=name, email=email, gender=gender, avatar=avatar, preview_avatar=preview_avatar)
-        user.set_password(password)
+        if password_hash:
+            user.password = password_hash
+        else:
+            user.set_password(password)
         user.save()
         return user
 
@@ -37,32 +60,124 @@ class UserManager(BaseUserManager):
         user.save()
 
     def authenticate(self, email=None, password=None):
+        user = self.get_for_login(email, password)
+        if user is None or not check_password(password, user.password):
+            return None
+        return self.log_in(user)
+
+    def get_for_login(self, email=None, password=None):
+        """The user trying to log in, its password is still to be checked"""
         if not email: raise ValueError('You must provide an email')
         if not password: raise ValueError('You must provide a password')
-        try:
-            user = self.get(email=email)
-            if not check_password(password, user.password):
-                return None
-
-            token = jwt.encode({'id': user.pk}, JWT_SECRET, JWT_ALGORITHM).decode('utf-8')
-            tokens = json.loads(user.tokens)
-            tokens.append(token)
-            user.tokens = json.dumps(tokens)
-            user.is_online = True
-            user.save()
-            return {'user': user, 'token': token}
-        except self.model.DoesNotExist:
-            return None
+        return self.filter(email=email).first()
+
+    def log_in(self, user):
+        """Issue a token to a user whose password was checked"""
+        from .models import Token
+        token = Token.objects.issue(user)
+        user.is_online = True
+        user.save()
+        return {'user': user, 'token': token}
 
     def authenticate_with_jwt(self, token):
         try:
-            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-            user = self.get(pk=payload['id'])
-            if not token in json.loads(user.tokens):
-                return None
-            if not user.is_online:
-                user.is_online = True
-                user.save()
+            user_pk = token_cache.get(token)
+            if user_pk is not None:
+                user = self.get(pk=user_pk)
+            else:
+                payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+                now = timezone.now()
+                user = self.get(Q(tokens__expires_at__isnull=True) | Q(tokens__expires_at__gt=now),
+                                pk=payload['id'], tokens__key=token_key(token))
+                expires_in = payload['exp'] - time.time() if 'exp' in payload else None
+                token_cache.set(token, user.pk, expires_in)
             return {'user': user, 'token': token}
-        except (jwt.DecodeError, self.model.DoesNotExist):
+        except (jwt.InvalidTokenError, self.model.DoesNotExist):
+            token_cache.invalidate(token)
             return None
+
+    def page(self, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """Get one page of the users, newest first"""
+        return keyset_paginate(self.all(), ('id',), cursor, limit)
+
+
+def count_rows(rows, field):
+    """
+    The number of `rows` pointing at each row of the outer query through `field`, as a correlated subquery.
+    Unlike a Count it needs no GROUP BY, so a page is still read from its index and only its rows are counted.
+    """
+    counts = rows.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(count=Count('*'))
+    return Coalesce(Subquery(counts.values('count'), output_field=models.IntegerField()), 0)
+
+
+class RoomManager(models.Manager):
+    """The manager of the Room class"""
+
+    ROOM_ORDERINGS = {
+        'recent': ('created_at', 'id'),
+        'active': ('last_activity_at', 'id'),
+        'watchers': ('watchers_count', 'id'),
+    }
+    # The orderings new rooms come first in, on top of the first page
+    NEW_ROOMS_FIRST = ('recent', 'active')
+
+    def page(self, sort='recent', cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """Get one page of rooms with their owner and watcher count in a single query"""
+        if sort not in self.ROOM_ORDERINGS:
+            raise ValueError(f'Rooms can only be sorted by {", ".join(self.ROOM_ORDERINGS)}')
+        watchers = count_rows(self.model.users_watching.through.objects, 'room')
+        rooms = self.select_related('user').annotate(watchers_count=watchers)
+        return keyset_paginate(rooms, self.ROOM_ORDERINGS[sort], cursor, limit)
+
+
+class PostManager(models.Manager):
+    """The manager of the Post class"""
+
+    def page(self, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """Get one page of the feed, newest posts first"""
+        from .models import Comment
+        posts = self.select_related('author').annotate(comments_count=count_rows(Comment.objects, 'post'))
+        return keyset_paginate(posts, ('posted_at', 'id'), cursor, limit)
+
+
+class CommentManager(models.Manager):
+    """The manager of the Comment class"""
+
+    def page(self, post_pk, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """Get one page of the comments of a post, newest comments first"""
+        comments = self.select_related('author').filter(post_id=post_pk)
+        return keyset_paginate(comments, ('created_at', 'id'), cursor, limit)
+
+
+class MessageManager(models.Manager):
+    """The manager of the Message class"""
+
+    def page(self, room_pk, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """Get one page of the history of a room, going back in time from the cursor"""
+        messages = self.select_related('author').filter(room_id=room_pk)
+        return keyset_paginate(messages, ('created_at', 'id'), cursor, limit)
+
+
+class TokenManager(models.Manager):
+    """The manager of the Token class"""
+
+    def issue(self, user, lifetime=TOKEN_LIFETIME):
+        """Create a new token for the user and return the encoded jwt"""
+        expires_at = timezone.now() + lifetime
+        payload = {'id': user.pk, 'jti': uuid4().hex, 'exp': expires_at}
+        token = jwt.encode(payload, JWT_SECRET, JWT_ALGORITHM).decode('utf-8')
+        self.create(user=user, key=token_key(token), expires_at=expires_at)
+        return token
+
+    def revoke(self, token):
+        token_cache.invalidate(token)
+        return self.filter(key=token_key(token)).delete()
+
+    def revoke_all(self, user):
+        """Log the user out of every device"""
+        token_cache.invalidate_user(user.pk)
+        return self.filter(user=user).delete()
+
+    def delete_expired(self):
+        """Delete the tokens past their expiry, done by the delete_expired_tokens command"""
+        return self.filter(expires_at__lte=timezone.now()).delete()
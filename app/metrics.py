@@ -0,0 +1,232 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.db.backends.signals import connection_created
+
+from .token_cache import token_cache
+
+# The message type being handled, set by the dispatcher, it follows the handler into the database threads
+current_handler = ContextVar('current_handler', default=None)
+# A one item list counting the queries of the handler, when the dispatcher checks its query budget
+current_queries = ContextVar('current_queries', default=None)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Registry:
+    """The metrics of the process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines += metric.samples()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def format_labels(names, values, extra=''):
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra: labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Value:
+    """The value of a counter or a gauge for one combination of labels"""
+    __slots__ = ('value', 'lock')
+
+    def __init__(self, lock=None):
+        self.value = 0
+        self.lock = lock
+
+    def inc(self, amount=1):
+        if self.lock is None:
+            self.value += amount
+            return
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets, lock=None):
+        self.buckets = buckets
+        # Bucket counts are kept per bucket and only made cumulative when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = lock
+
+    def observe(self, value):
+        if self.lock is None:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            return
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+
+class Metric:
+    """
+    A metric with a value per combination of labels, `labels(...)` returns it so hot paths can keep it.
+    Only the metrics updated from the threads running the database calls (`threadsafe`) take a lock,
+    the others are only updated from the event loop and stay cheap enough for the path of every frame.
+    """
+    type = None
+
+    def __init__(self, name, help, labels=(), threadsafe=False):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+        self.lock = threading.Lock() if threadsafe else None
+        registry.register(self)
+
+    def new_value(self):
+        return Value(self.lock)
+
+    def labels(self, *labels):
+        value = self.values.get(labels)
+        if value is None: value = self.values.setdefault(labels, self.new_value())
+        return value
+
+    def samples(self):
+        # Copying the items doesn't let other threads run, no need for the lock
+        values = list(self.values.items())
+        return [f'{self.name}{format_labels(self.label_names, labels)} {value.value}' for labels, value in values]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.labels(*labels).inc(amount)
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.labels(*labels).inc(-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, threadsafe=False):
+        super().__init__(name, help, labels, threadsafe)
+        self.buckets = buckets
+
+    def new_value(self):
+        return HistogramValue(self.buckets, self.lock)
+
+    def observe(self, value, *labels):
+        self.labels(*labels).observe(value)
+
+    def samples(self):
+        values = [(labels, list(value.counts), value.sum) for labels, value in list(self.values.items())]
+        samples = []
+        for labels, counts, total_sum in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                bucket_labels = format_labels(self.label_names, labels, f'le="{bound}"')
+                samples.append(f'{self.name}_bucket{bucket_labels} {total}')
+            samples.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {total_sum}')
+            samples.append(f'{self.name}_count{format_labels(self.label_names, labels)} {total}')
+        return samples
+
+
+class CallbackMetric(Metric):
+    """A metric kept by something else, `read()` returns its values by labels when it is rendered"""
+
+    def __init__(self, name, help, type, read, labels=()):
+        super().__init__(name, help, labels)
+        self.type = type
+        self.read = read
+
+    def samples(self):
+        return [f'{self.name}{format_labels(self.label_names, labels)} {value}' for labels, value in self.read().items()]
+
+
+def handler_stats(field):
+    """The stats of the handlers of every dispatcher, the ones known so far"""
+    from .dispatch import Dispatcher
+    values = {}
+    for dispatcher in Dispatcher.instances:
+        for type, stats in dispatcher.stats.items():
+            value = getattr(stats, field)
+            if stats.calls and value is not None: values[(type,)] = value
+    return values
+
+
+CONNECTIONS = Gauge('watch_together_connections', 'Open websocket connections', ('consumer',))
+MESSAGES = Counter('watch_together_messages_total', 'Messages received, by type', ('type',))
+HANDLER_SECONDS = Histogram('watch_together_handler_seconds', 'Time spent handling a message', ('type',))
+HANDLER_ERRORS = Counter('watch_together_handler_errors_total', 'Messages answered with an error', ('type',))
+DB_QUEUE_DEPTH = Gauge('watch_together_db_queue_depth', 'Database calls waiting for a thread', threadsafe=True)
+DB_WAIT_SECONDS = Histogram('watch_together_db_wait_seconds', 'Time database calls wait for a thread',
+                            threadsafe=True)
+DB_CALLS_REFUSED = Counter('watch_together_db_calls_refused_total',
+                           'Database calls turned away with a full queue or given up after the timeout', ('reason',))
+DB_QUERIES = Counter('watch_together_db_queries_total', 'Database queries, by message type', ('handler',),
+                     threadsafe=True)
+DB_SECONDS = Counter('watch_together_db_seconds_total', 'Time spent in database queries, by message type',
+                     ('handler',), threadsafe=True)
+GROUP_SENDS = Counter('watch_together_group_sends_total', 'Frames sent to a group, by type', ('type',))
+GROUP_DELIVERIES = Counter('watch_together_group_deliveries_total',
+                           'Group frames forwarded to a connection, by type (divided by the sends: the fanout)',
+                           ('type',))
+GROUP_FANOUT = Histogram('watch_together_group_fanout', 'Channels in the group of a group send',
+                         buckets=FANOUT_BUCKETS)
+LAYER_DELIVERIES = Counter('watch_together_layer_deliveries_total',
+                           'Channel layer messages, delivered in process or through Redis', ('route',))
+TOKEN_CACHE_LOOKUPS = CallbackMetric('watch_together_token_cache_lookups_total', 'Token cache lookups, by result',
+                                     'counter', lambda: {('hit',): token_cache.hits, ('miss',): token_cache.misses},
+                                     ('result',))
+TOKEN_CACHE_SIZE = CallbackMetric('watch_together_token_cache_size', 'Tokens in the token cache', 'gauge',
+                                  lambda: {(): token_cache.stats()['size']})
+HANDLER_MAX_SECONDS = CallbackMetric('watch_together_handler_max_seconds', 'Longest time spent handling a message',
+                                     'gauge', lambda: handler_stats('max_time'), ('type',))
+HANDLER_MAX_QUERIES = CallbackMetric('watch_together_handler_max_queries',
+                                     'Most queries made handling a message, known when the query budgets are checked',
+                                     'gauge', lambda: handler_stats('max_queries'), ('type',))
+SENT_FRAMES = Counter('watch_together_sent_frames_total', 'Frames sent to the clients', ('protocol',))
+SENT_BYTES = Counter('watch_together_sent_bytes_total', 'Bytes of the frames sent to the clients', ('protocol',))
+
+
+def count_query(execute, sql, params, many, context):
+    handler = current_handler.get() or 'none'
+    queries = current_queries.get()
+    if queries is not None: queries[0] += 1
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERIES.inc(handler)
+        DB_SECONDS.inc(handler, amount=time.perf_counter() - start)
+
+
+def instrument_connection(connection, **kwargs):
+    if count_query not in connection.execute_wrappers: connection.execute_wrappers.append(count_query)
+
+
+connection_created.connect(instrument_connection)
+
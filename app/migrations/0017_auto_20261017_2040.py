@@ -0,0 +1,17 @@
+# Generated by Django 3.0.4 on 2026-10-17 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_auto_20261017_2039'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'created_at'], name='app_message_room_id_60c8c6_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.0.4 on 2026-10-17 20:41
+
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def move_tokens(apps, schema_editor):
+    User = apps.get_model('app', 'User')
+    Token = apps.get_model('app', 'Token')
+    # The old tokens never expired, give them the lifetime of a new one from now on
+    expires_at = timezone.now() + timedelta(days=30)
+    keys = set()
+    new_tokens = []
+    for user_pk, tokens in User.objects.values_list('pk', 'tokens').iterator():
+        for token in json.loads(tokens or '[]'):
+            key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+            if key in keys: continue
+            keys.add(key)
+            new_tokens.append(Token(user_id=user_pk, key=key, expires_at=expires_at))
+    Token.objects.bulk_create(new_tokens, batch_size=500)
+
+
+def restore_tokens(apps, schema_editor):
+    # Only the hashes are kept, the tokens themselves can't be restored and users have to log in again
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_auto_20261017_2040'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Token',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(move_tokens, restore_tokens),
+        migrations.RemoveField(
+            model_name='user',
+            name='tokens',
+        ),
+    ]
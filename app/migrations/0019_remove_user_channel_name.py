@@ -0,0 +1,17 @@
+# Generated by Django 3.0.4 on 2026-10-17 20:43
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_token'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='user',
+            name='channel_name',
+        ),
+    ]
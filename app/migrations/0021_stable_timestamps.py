@@ -0,0 +1,77 @@
+# Generated by Django 3.0.4 on 2026-10-17 21:11
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def backfill(apps, schema_editor):
+    """Date the new columns from what the rows already tell, rather than from the migration"""
+    Room, Message, Post, Comment = (apps.get_model('app', name) for name in ('Room', 'Message', 'Post', 'Comment'))
+    newest = Message.objects.filter(room=OuterRef('pk')).order_by('-created_at').values('created_at')[:1]
+    Room.objects.update(last_activity_at=Coalesce(Subquery(newest), F('created_at')))
+    Post.objects.update(updated_at=F('posted_at'))
+    Comment.objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_auto_20261017_2053'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='posted_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='room',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'created_at'], name='app_comment_post_id_494cb6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['posted_at', 'id'], name='app_post_posted__7a937b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['created_at', 'id'], name='app_room_created_f94033_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['last_activity_at', 'id'], name='app_room_last_ac_7392ac_idx'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
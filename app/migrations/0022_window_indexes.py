@@ -0,0 +1,29 @@
+# Generated by Django 3.0.4 on 2026-10-17 21:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_stable_timestamps'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='comment',
+            name='app_comment_post_id_494cb6_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='app_message_room_id_60c8c6_idx',
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'created_at', 'id'], name='app_comment_post_id_b74b35_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'created_at', 'id'], name='app_message_room_id_00a3c0_idx'),
+        ),
+    ]
@@ -1,9 +1,9 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 
-from random import choice
 # Create your models here.
-from .managers import UserManager
+from .managers import UserManager, TokenManager, RoomManager, MessageManager, PostManager, CommentManager
 
 
 class User(AbstractBaseUser, PermissionsMixin):
@@ -11,12 +11,10 @@ class User(AbstractBaseUser, PermissionsMixin):
     objects = UserManager()
     USERNAME_FIELD = 'email'
 
-    tokens = models.TextField(max_length=100000, default='[]')
-    channel_name = models.CharField(max_length=255, default='')
-
     email = models.EmailField(max_length=200, unique=True)
     name = models.CharField(default='Anonymous', unique=False, max_length=100)
-    created_at = models.DateTimeField(auto_now=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     is_online = models.BooleanField(default=False)
 
@@ -40,21 +38,11 @@ class User(AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return self.name
 
-    def as_dict(self):
-        return {
-            'name': self.name,
-            'email': self.email,
-            'is_online': self.is_online,
-            'friends': [friend.as_min_dict() for friend in self.friends.all()],
-            'id': self.pk
-        }
-
-    def as_min_dict(self):
-        return {
-            'name': self.name,
-            'is_online': self.is_online,
-            'id': self.pk
-        }
+    def save(self, *args, **kwargs):
+        # A new password logs the user out of every device once it is saved, the tokens as well as their cache
+        password_changed = self._password is not None and self.pk is not None
+        super().save(*args, **kwargs)
+        if password_changed: Token.objects.revoke_all(self)
 
     def create_room(self, video_url='', name=''):
         if not video_url:
@@ -62,78 +50,30 @@ class User(AbstractBaseUser, PermissionsMixin):
         if not name:
             raise ValueError('A room must have a name')
         video_url, name = video_url.strip(), name.strip()
-        room = Room.objects.create(video_url=video_url, name=name, user=self)
-        room.save()
-        self.room = room
-        self.save()
-        return self.room
-
-    def join_room(self, room_pk=None):
-        if not room_pk: raise ValueError('Please provide the id of the room')
-        room = Room.objects.get(pk=room_pk)
-        self.room = room
-        room.users_watching.add(self)
-        room.save()
-        self.save()
-        return self.room
-
-    def leave_room(self, user_to_inherit=None):
-        if not self.room: raise ValueError('You must in a room first')
-        try:
-            self.room.users_watching.get(pk=user_to_inherit.pk)
-            self.room.user = user_to_inherit
-        except:
-            if len(self.room.users_watching.all()):
-                user_to_inherit = choice(self.room.users_watching.all())
-                self.room.user = user_to_inherit
-            else:
-                self.room.delete()
-        self.room.save()
-        self.room = None
-        self.save()
-
-        return self
+        # Joining it is up to the room registry, see app.rooms
+        return Room.objects.create(video_url=video_url, name=name, user=self)
 
     def add_friend(self, user_pk=None):
         if user_pk is None: raise ValueError('You must provide a user')
         user = User.objects.get(pk=user_pk)
+        if user.pk == self.pk: raise ValueError('You can\'t be your own friend')
+        # The relation is symmetrical, this makes both users friends
         self.friends.add(user)
-        user.friends.add(self)
-        self.save()
-        user.save()
-        return self.friends.all()
+        return user
 
     def remove_friend(self, user_pk=None):
         if user_pk is None: raise ValueError('You must provide a user')
-        self.friends.get(pk=user_pk).delete()
-        self.save()
-        user = User.objects.get(pk=user_pk)
-        user.friends.get(pk=self.pk).delete()
-        user.save()
-        return self.friends.all()
-
-    def delete_room(self):
-        if not self.room:
-            raise ValueError('You must be in a room first')
-        if not self.room.user.pk == self.pk:
-            raise ValueError('You are not the owner of this room')
-
-        self.room.delete()
-        self.room = None
-        self.save()
-        return self
+        user = self.friends.get(pk=user_pk)
+        self.friends.remove(user)
+        return user
 
     def send_message(self, message_text=None):
         if not message_text: raise ValueError('You must provide the message text')
         if not self.room:
             raise AttributeError('You aren\'t in any room')
 
-        message_text = message_text.strip()
-        message = self.message_set.create(message_text=message_text, room=self.room)
-        message.save()
-        self.save()
-        self.room.save()
-        return message
+        # The websocket goes through the chat buffer (app.chat), this writes the message right away
+        return self.message_set.create(message_text=message_text.strip(), room_id=self.room_id)
 
     def create_post(self, post_text=None):
         if not post_text: raise ValueError('You must provide text for your post')
@@ -170,7 +110,6 @@ class User(AbstractBaseUser, PermissionsMixin):
                 me.delete()
             except User.DoesNotExist:
                 post.likes.add(self)
-            post.save()
         except Post.DoesNotExist:
             raise ValueError('Post not found')
 
@@ -179,7 +118,7 @@ class User(AbstractBaseUser, PermissionsMixin):
         if not comment_text: raise ValueError('You must provide the comment')
         try:
             post = Post.objects.get(pk=post_pk)
-            comment = post.comments_set.create(comment_text=comment_text, author=self)
+            comment = post.comment_set.create(comment_text=comment_text, author=self)
             comment.save()
             return comment
         except Post.DoesNotExist:
@@ -205,81 +144,70 @@ class User(AbstractBaseUser, PermissionsMixin):
             raise ValueError('Comment does not exist')
 
 
+class Token(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='tokens')
+    key = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(null=True, db_index=True)
+    objects = TokenManager()
+
+    def __str__(self):
+        return f'user: {self.user_id}, expires: {self.expires_at}'
+
+
 class Room(models.Model):
     video_url = models.URLField()
     users_watching = models.ManyToManyField(User, related_name='room_watching_users')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='room_creator', default=None)
     name = models.CharField(max_length=300)
+    objects = RoomManager()
 
-    created_at = models.DateTimeField(auto_now=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # The last message or join, written with them by the chat buffer and the room registry
+    last_activity_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['created_at', 'id']), models.Index(fields=['last_activity_at', 'id'])]
 
     def __str__(self):
         return f'url: {self.video_url}, owner: {self.user.name}'
 
-    def as_preview_dict(self):
-        return {
-            'name': self.name,
-            'number_of_users_watching': len(self.users_watching.all()),
-            'user': self.user.as_min_dict(),
-            'id': self.pk
-        }
-
-    def as_dict(self):
-        return {
-            'name': self.name,
-            'users_watching': [user.as_min_dict() for user in self.users_watching.all()],
-            'user': self.user.as_min_dict(),
-            'messages': [message.as_dict() for message in self.message_set.all()],
-            'id': self.pk
-        }
-
 
 class Message(models.Model):
     author = models.ForeignKey('User', on_delete=models.CASCADE)
     room = models.ForeignKey('Room', on_delete=models.CASCADE)
     message_text = models.CharField(max_length=10000)
 
-    created_at = models.DateTimeField(auto_now=True)
+    # Set when the message is received, it is written later by the chat buffer
+    created_at = models.DateTimeField(default=timezone.now)
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['room', 'created_at', 'id'])]
 
     def __str__(self):
         return f'author: {self.author}, message: {self.message_text[:30]}'
 
-    def as_dict(self):
-        return {
-            'message_text': self.message_text,
-            'created_at': self.created_at,
-            'author': self.author.as_min_dict(),
-            'id': self.pk
-        }
-
 
 class Post(models.Model):
     author = models.ForeignKey('User', on_delete=models.CASCADE)
     post_text = models.TextField(max_length=1000000)
-    posted_at = models.DateTimeField(auto_now=True)
-    likes = models.ManyToManyField('User', on_delete=models.CASCADE)
+    posted_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    likes = models.ManyToManyField('User', related_name='liked_posts')
+    objects = PostManager()
 
-    def as_dict(self):
-        return {
-            'author': self.author.as_min_dict(),
-            'post_text': self.post_text,
-            'posted_at': self.posted_at,
-            'likes': [like.as_min_dict() for like in self.likes.all()],
-            'comments': [comment.as_dict() for comment in self.comment_set.order_by('-created_at')],
-            'id': self.pk
-        }
+    class Meta:
+        indexes = [models.Index(fields=['posted_at', 'id'])]
 
 
 class Comment(models.Model):
     author = models.ForeignKey('User', on_delete=models.CASCADE)
     post = models.ForeignKey('Post', on_delete=models.CASCADE)
     comment_text = models.TextField(max_length=1000000)
-    created_at = models.DateTimeField(auto_now=True)
-
-    def as_dict(self):
-        return {
-            'author': self.author.as_min_dict(),
-            'comment_text': self.comment_text,
-            'created_at': self.created_at,
-            'id': self.pk
-        }
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = CommentManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['post', 'created_at', 'id'])]
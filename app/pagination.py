@@ -0,0 +1,85 @@
+import base64
+import json
+from datetime import datetime
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def page_size(value=None, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Clamp the page size asked for by a client"""
+    if value is None: return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('The page size must be a number')
+    if value < 1: raise ValueError('The page size must be positive')
+    return min(value, maximum)
+
+
+def _cursor_value(value):
+    # isoformat keeps the microseconds, which DjangoJSONEncoder would truncate
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Cannot use {type(value).__name__} in a cursor')
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=_cursor_value).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor, model, fields):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (AttributeError, ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise ValueError('Invalid cursor')
+
+    decoded = []
+    for field, value in zip(fields, values):
+        try:
+            model_field = model._meta.get_field(field)
+        except FieldDoesNotExist:
+            model_field = None
+        # Cursors come from clients, a value of the wrong type must not reach the query
+        if isinstance(model_field, models.DateTimeField):
+            if not isinstance(value, str): raise ValueError('Invalid cursor')
+            try:
+                value = parse_datetime(value)
+            except ValueError:
+                value = None
+            if value is None: raise ValueError('Invalid cursor')
+        elif not isinstance(value, int) or isinstance(value, bool):
+            # The other fields of the orderings are ids, counts and offsets
+            raise ValueError('Invalid cursor')
+        decoded.append(value)
+    return decoded
+
+
+def keyset_paginate(queryset, fields, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return one page of the queryset ordered by `fields` (all descending) and the cursor of the next page.
+    The last field must be unique (usually `id`) so that the ordering is total.
+    """
+    if cursor:
+        values = decode_cursor(cursor, queryset.model, fields)
+        condition = Q()
+        for i, field in enumerate(fields):
+            step = Q(**{f'{field}__lt': values[i]})
+            for previous, value in zip(fields[:i], values[:i]):
+                step &= Q(**{previous: value})
+            condition |= step
+        queryset = queryset.filter(condition)
+
+    objects = list(queryset.order_by(*[f'-{field}' for field in fields])[:limit + 1])
+    if len(objects) <= limit:
+        return objects, None
+    objects = objects[:limit]
+    return objects, encode_cursor([getattr(objects[-1], field) for field in fields])
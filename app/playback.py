@@ -0,0 +1,125 @@
+import json
+import math
+import time
+
+from .shared_state import redis_address, RedisConnection
+
+PLAYING = 'playing'
+PAUSED = 'paused'
+PLAYBACK_KEY_TTL = 60 * 60 * 24
+
+
+class PlaybackState:
+    """
+    Where the video of a room is, as of `updated_at` (server time in seconds).
+    While playing the position moves by `rate` seconds every second, so clients can extrapolate it
+    with their estimated clock offset instead of waiting for updates.
+    """
+
+    def __init__(self, status=PAUSED, position=0.0, rate=1.0, updated_at=None, version=0):
+        self.status = status
+        self.position = position
+        self.rate = rate
+        self.updated_at = time.time() if updated_at is None else updated_at
+        self.version = version
+
+    def position_at(self, now):
+        if self.status != PLAYING: return self.position
+        return self.position + (now - self.updated_at) * self.rate
+
+    def _moved(self, status=None, position=None, rate=None):
+        now = time.time()
+        if position is None: position = self.position_at(now)
+        if not math.isfinite(position) or position < 0: raise ValueError('The position must be a positive number')
+        return PlaybackState(status or self.status, position, self.rate if rate is None else rate, now,
+                             self.version + 1)
+
+    def play(self, position=None):
+        return self._moved(PLAYING, position)
+
+    def pause(self, position=None):
+        return self._moved(PAUSED, position)
+
+    def seek(self, position):
+        return self._moved(position=position)
+
+    def set_rate(self, rate):
+        if not math.isfinite(rate) or not 0 < rate <= 4: raise ValueError('The rate must be between 0 and 4')
+        return self._moved(rate=rate)
+
+    def as_dict(self):
+        return {
+            'status': self.status,
+            'position': self.position,
+            'rate': self.rate,
+            'updated_at': self.updated_at,
+            'version': self.version
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['status'], data['position'], data['rate'], data['updated_at'], data['version'])
+
+
+class MemoryPlaybackStore:
+    def __init__(self):
+        self._states = {}
+
+    async def get(self, room_pk):
+        return self._states.get(room_pk) or PlaybackState()
+
+    async def set(self, room_pk, state):
+        self._states[room_pk] = state
+
+    async def delete(self, room_pk):
+        self._states.pop(room_pk, None)
+
+
+class RedisPlaybackStore:
+    """Shares the states between processes, the last update wins"""
+
+    def __init__(self, address, prefix='playback:'):
+        self.redis = RedisConnection(address)
+        self.prefix = prefix
+
+    async def get(self, room_pk):
+        redis = await self.redis.get()
+        data = await redis.get(f'{self.prefix}{room_pk}')
+        return PlaybackState.from_dict(json.loads(data)) if data else PlaybackState()
+
+    async def set(self, room_pk, state):
+        redis = await self.redis.get()
+        await redis.set(f'{self.prefix}{room_pk}', json.dumps(state.as_dict()), expire=PLAYBACK_KEY_TTL)
+
+    async def delete(self, room_pk):
+        redis = await self.redis.get()
+        await redis.delete(f'{self.prefix}{room_pk}')
+
+
+class Playback:
+    """The playback states of the rooms, kept out of the database"""
+
+    def __init__(self, store=None):
+        self._store = store
+
+    @property
+    def store(self):
+        if self._store is None:
+            address = redis_address()
+            self._store = RedisPlaybackStore(address) if address else MemoryPlaybackStore()
+        return self._store
+
+    async def get(self, room_pk):
+        return await self.store.get(room_pk)
+
+    async def update(self, room_pk, action, *args):
+        """Apply `action` ('play', 'pause', 'seek' or 'set_rate') and return the new state"""
+        state = getattr(await self.store.get(room_pk), action)(*args)
+        await self.store.set(room_pk, state)
+        return state
+
+    async def close(self, room_pk):
+        await self.store.delete(room_pk)
+
+
+playback = Playback()
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+
+from .changes import change_logs
+from .database import background, database_sync_to_async as s2as
+from .friends import friend_graph
+from .groups import user_group
+from .models import User
+from .protocol import group_frame
+from .shared_state import redis_address, RedisConnection
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_FLUSH_INTERVAL = 1
+PRESENCE_OFFLINE_GRACE = 5
+PRESENCE_KEY_TTL = 60 * 60 * 24
+
+
+class MemoryPresenceStore:
+    """Keeps the open connections of each user in memory, for a single process deployment"""
+
+    def __init__(self):
+        self._channels = {}
+
+    async def add(self, user_pk, channel_name):
+        self._channels.setdefault(user_pk, set()).add(channel_name)
+
+    async def remove(self, user_pk, channel_name):
+        channels = self._channels.get(user_pk)
+        if channels is None: return
+        channels.discard(channel_name)
+        if not channels: del self._channels[user_pk]
+
+    async def online(self, user_pks):
+        return {user_pk for user_pk in user_pks if user_pk in self._channels}
+
+
+class RedisPresenceStore:
+    """Keeps the open connections of each user in a redis set, shared by every process"""
+
+    def __init__(self, address, prefix='presence:'):
+        self.redis = RedisConnection(address)
+        self.prefix = prefix
+
+    async def add(self, user_pk, channel_name):
+        redis = await self.redis.get()
+        key = f'{self.prefix}{user_pk}'
+        transaction = redis.multi_exec()
+        transaction.sadd(key, channel_name)
+        # Connections of a crashed process would keep the user online forever without an expiry
+        transaction.expire(key, PRESENCE_KEY_TTL)
+        await transaction.execute()
+
+    async def remove(self, user_pk, channel_name):
+        redis = await self.redis.get()
+        await redis.srem(f'{self.prefix}{user_pk}', channel_name)
+
+    async def online(self, user_pks):
+        user_pks = list(user_pks)
+        if not user_pks: return set()
+        redis = await self.redis.get()
+        pipeline = redis.pipeline()
+        futures = [pipeline.scard(f'{self.prefix}{user_pk}') for user_pk in user_pks]
+        await pipeline.execute()
+        counts = await asyncio.gather(*futures)
+        return {user_pk for user_pk, count in zip(user_pks, counts) if count}
+
+
+def default_store():
+    address = redis_address()
+    return RedisPresenceStore(address) if address else MemoryPresenceStore()
+
+
+class Presence:
+    """
+    Tracks who is online and tells their friends.
+    Changes are coalesced and sent every `flush_interval` seconds as one `presence` frame per friend,
+    a user only goes offline once they stayed disconnected for `offline_grace` seconds
+    so that flapping connections don't produce any update.
+    The first flush also takes the users the database has online, so that those left online
+    by a process that crashed or restarted go offline unless they are connected somewhere.
+    """
+
+    def __init__(self, store=None, flush_interval=PRESENCE_FLUSH_INTERVAL, offline_grace=PRESENCE_OFFLINE_GRACE):
+        self._store = store
+        self.flush_interval = flush_interval
+        self.offline_grace = offline_grace
+        self._pending = {}  # user pk -> time of the last change
+        self._published = {}  # user pk -> last state sent to the friends
+        self._flush_handle = None
+        self._flush_loop = None
+        self._reconciled = False
+
+    @property
+    def store(self):
+        if self._store is None: self._store = default_store()
+        return self._store
+
+    async def connect(self, user_pk, channel_name):
+        await self.store.add(user_pk, channel_name)
+        self._touch(user_pk)
+
+    async def disconnect(self, user_pk, channel_name):
+        await self.store.remove(user_pk, channel_name)
+        self._touch(user_pk)
+
+    async def online(self, user_pks):
+        return await self.store.online(user_pks)
+
+    def _touch(self, user_pk):
+        self._pending[user_pk] = time.monotonic()
+        self._schedule(self.flush_interval)
+
+    def _schedule(self, delay):
+        loop = asyncio.get_event_loop()
+        # A flush scheduled on a loop that has since been closed would never run
+        if self._flush_handle is not None and self._flush_loop is loop: return
+        self._flush_loop = loop
+        self._flush_handle = loop.call_later(delay, lambda: background(self.flush()))
+
+    async def flush(self):
+        self._flush_handle = None
+        try:
+            if not self._reconciled: await self._reconcile()
+            await self._flush()
+        except Exception:
+            logger.exception('Could not flush the presence changes')
+        finally:
+            # What is still pending, the changes of a failed flush included, goes with the next flush
+            if self._pending: self._schedule(self.flush_interval)
+
+    async def _flush(self):
+        now = time.monotonic()
+        user_pks = list(self._pending)
+        online = await self.store.online(user_pks)
+
+        changes, touched = {}, {}
+        for user_pk in user_pks:
+            is_online = user_pk in online
+            if not is_online and now - self._pending[user_pk] < self.offline_grace: continue
+            touched_at = self._pending.pop(user_pk)
+            if self._published.get(user_pk) == is_online: continue
+            changes[user_pk] = is_online
+            touched[user_pk] = touched_at
+            self._publish(user_pk, is_online)
+
+        if not changes: return
+        try:
+            await self.publish(changes)
+        except Exception:
+            for user_pk, is_online in changes.items():
+                self._pending.setdefault(user_pk, touched[user_pk])
+                self._publish(user_pk, not is_online)
+            raise
+
+    def _publish(self, user_pk, is_online):
+        if is_online:
+            self._published[user_pk] = True
+        else:
+            self._published.pop(user_pk, None)
+
+    async def _reconcile(self):
+        # Without their grace period, the ones that aren't connected go offline with this flush
+        for user_pk in await s2as(online_users)():
+            self._pending.setdefault(user_pk, time.monotonic() - self.offline_grace)
+        self._reconciled = True
+
+    async def publish(self, changes):
+        friends = await s2as(save_presence, critical=True)(changes)
+        for user_pk, is_online in changes.items():
+            change_logs.users.update(user_pk, {'is_online': is_online})
+        for friend_pk, user_pks in friends.items():
+            log = change_logs.friends(friend_pk, create=False)
+            if log is None: continue
+            for user_pk in user_pks:
+                log.update(user_pk, {'is_online': changes[user_pk]})
+        online_friends = await self.store.online(friends)
+        channel_layer = get_channel_layer()
+        for friend_pk in online_friends:
+            users = [{'id': user_pk, 'is_online': changes[user_pk]} for user_pk in friends[friend_pk]]
+            await channel_layer.group_send(user_group(friend_pk), group_frame('presence', {'users': users}))
+
+
+def online_users():
+    return list(User.objects.filter(is_online=True).values_list('pk', flat=True))
+
+
+def save_presence(changes):
+    """
+    Store the new states in two queries and return the friends to notify with the users they care about,
+    found in the friend graph
+    """
+    went_online = [user_pk for user_pk, is_online in changes.items() if is_online]
+    went_offline = [user_pk for user_pk, is_online in changes.items() if not is_online]
+    if went_online: User.objects.filter(pk__in=went_online).update(is_online=True)
+    if went_offline: User.objects.filter(pk__in=went_offline).update(is_online=False)
+
+    friends = {}
+    for user_pk, friend_pks in friend_graph.friends_of(changes).items():
+        for friend_pk in friend_pks:
+            friends.setdefault(friend_pk, []).append(user_pk)
+    return friends
+
+
+presence = Presence()
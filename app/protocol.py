@@ -0,0 +1,67 @@
+import json
+from functools import lru_cache
+from urllib.parse import parse_qs
+
+import msgpack
+
+from .metrics import GROUP_SENDS
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+PROTOCOLS = (JSON, MSGPACK)
+# The binary frames of the latest group frames, shared by the MessagePack recipients of the process
+BINARY_FRAME_CACHE_SIZE = 256
+
+
+def format_message(type, data):
+    return json.dumps({
+        'type': type, 'data': data
+    })
+
+
+def format_message_reverse(json_data):
+    data = json.loads(json_data)
+    return data.get('type'), data.get('data')
+
+
+def format_message_binary(type, data):
+    return msgpack.packb({'type': type, 'data': data}, use_bin_type=True)
+
+
+def format_message_binary_reverse(binary_data):
+    try:
+        data = msgpack.unpackb(binary_data, raw=False)
+    except msgpack.UnpackException as err:
+        raise ValueError(str(err))
+    return data.get('type'), data.get('data')
+
+
+def group_frame(type, data):
+    """
+    A group message carrying the JSON frame, forwarded as-is by the JSON recipients.
+    The MessagePack one is only encoded when a recipient uses it, see `binary_frame`.
+    """
+    GROUP_SENDS.inc(type)
+    return {
+        'type': 'websocket.send',
+        'frame': type,
+        'text': format_message(type, data)
+    }
+
+
+@lru_cache(maxsize=BINARY_FRAME_CACHE_SIZE)
+def binary_frame(text):
+    """The MessagePack frame of a group frame, encoded once per process however many recipients use it"""
+    return msgpack.packb(json.loads(text), use_bin_type=True)
+
+
+def negotiate(subprotocols=(), query_string=b''):
+    """
+    The protocol asked for by a connecting client, through the websocket subprotocol or `?protocol=`.
+    Returns the protocol and the subprotocol to accept, JSON is the default.
+    """
+    for subprotocol in subprotocols:
+        if subprotocol in PROTOCOLS: return subprotocol, subprotocol
+    protocol = parse_qs(query_string.decode('latin-1')).get('protocol', [None])[0]
+    if protocol in PROTOCOLS: return protocol, None
+    return JSON, None
@@ -0,0 +1,299 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models import Case, When
+from django.utils import timezone
+
+from .changes import change_logs
+from .database import background, database_sync_to_async as s2as
+from .models import User, Room
+from .serializers import UserMinSerializer, RoomPreviewSerializer
+
+logger = logging.getLogger(__name__)
+
+ROOMS_FLUSH_INTERVAL = 1
+# Failed writes are retried, waiting twice as long after each failure up to this
+ROOMS_RETRY_MAX_DELAY = 30
+
+
+class RoomActor:
+    """
+    The live state of a room: its members in join order and its owner.
+    Mutations go through a mailbox processed by a single task, so they never interleave,
+    and are written to the database later by the registry.
+    Actors are per process, a deployment with several workers must route the members of a room to the same one.
+    An actor left without members, or without a room to load, stops once its mailbox is empty,
+    the next call to the room starts a new one.
+    """
+
+    def __init__(self, registry, room_pk):
+        self.registry = registry
+        self.room_pk = room_pk
+        self.owner_pk = None
+        self.members = OrderedDict()  # user pk -> min dict
+        self.loaded = False
+        self.closed = False
+        self._mailbox = asyncio.Queue()
+        self._task = background(self._run())
+
+    async def _run(self):
+        while not (self.closed and self._mailbox.empty()):
+            operation, future = await self._mailbox.get()
+            if future.cancelled(): continue
+            if self.closed:
+                future.set_exception(Room.DoesNotExist('Room not found'))
+                continue
+            try:
+                if not self.loaded: await self._load()
+                future.set_result(operation())
+            except Exception as exc:
+                future.set_exception(exc)
+            if not self.members and self._mailbox.empty(): self.stop()
+
+    async def call(self, operation):
+        if self.closed: raise Room.DoesNotExist('Room not found')
+        future = asyncio.get_event_loop().create_future()
+        self._mailbox.put_nowait((operation, future))
+        return await future
+
+    async def _load(self):
+        if self.room_pk in self.registry.closed_rooms: raise Room.DoesNotExist('Room not found')
+        self.owner_pk, members = await s2as(load_room)(self.room_pk)
+        for user in members:
+            self.members[user.pk] = UserMinSerializer.to_dict(user)
+        self.loaded = True
+
+    def join(self, user):
+        if user.pk in self.members: return
+        self.members[user.pk] = UserMinSerializer.to_dict(user)
+        self.registry.record_join(self.room_pk, user.pk)
+        if self.owner_pk is None: self.set_owner(user.pk)
+        self.record_preview()
+
+    def leave(self, user_pk):
+        """Remove the member and return the new owner, the room closes when its last member leaves"""
+        if user_pk not in self.members: raise ValueError('You must in a room first')
+        del self.members[user_pk]
+        self.registry.record_leave(self.room_pk, user_pk)
+        if not self.members:
+            self.close()
+        else:
+            # The member who joined first after the owner inherits the room
+            if self.owner_pk == user_pk: self.set_owner(next(iter(self.members)))
+            self.record_preview()
+        return self.owner_pk
+
+    def delete(self, user_pk):
+        if user_pk not in self.members: raise ValueError('You must be in a room first')
+        if self.owner_pk != user_pk: raise ValueError('You are not the owner of this room')
+        snapshot = self.snapshot()
+        self.close()
+        return snapshot
+
+    def set_owner(self, user_pk):
+        self.owner_pk = user_pk
+        self.registry.record_owner(self.room_pk, user_pk)
+
+    def close(self):
+        self.closed = True
+        self.registry.record_close(self.room_pk)
+        change_logs.rooms.remove(self.room_pk)
+
+    def stop(self):
+        """Stop without closing the room, which stays as it is in the database"""
+        self.closed = True
+        if self.registry.actors.get(self.room_pk) is self: del self.registry.actors[self.room_pk]
+
+    def record_preview(self):
+        """Record what changed in the preview of the room for the clients syncing the list of rooms"""
+        change_logs.rooms.update(self.room_pk, {
+            'number_of_users_watching': len(self.members),
+            'user': self.members.get(self.owner_pk)
+        })
+
+    def snapshot(self):
+        snapshot = {'users_watching': list(self.members.values())}
+        if self.owner_pk in self.members: snapshot['user'] = self.members[self.owner_pk]
+        return snapshot
+
+
+def load_room(room_pk):
+    room = Room.objects.get(pk=room_pk)
+    watching = Room.users_watching.through.objects.filter(room_id=room_pk).select_related('user').order_by('pk')
+    members = [row.user for row in watching]
+    member_pks = {user.pk for user in members}
+    members += [user for user in User.objects.filter(room_id=room_pk).order_by('pk') if user.pk not in member_pks]
+    return room.user_id, members
+
+
+class RoomRegistry:
+    """
+    The actors of the active rooms and the writes they are waiting to make.
+    Writes are coalesced per row and flushed every `flush_interval` seconds in one transaction.
+    """
+
+    def __init__(self, flush_interval=ROOMS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._flush_handle = None
+        self.reset()
+
+    def reset(self):
+        """Forget the actors and the changes not written yet"""
+        if self._flush_handle is not None: self._flush_handle.cancel()
+        self.actors = {}
+        self.closed_rooms = set()
+        self._pending = self._empty_pending()
+        self._flush_handle = None
+        self._flush_loop = None
+        self._writing = None
+        self._failures = 0
+        # The version of the rooms change log the database is up to date with
+        self.written_version = change_logs.rooms.version
+
+    @staticmethod
+    def _empty_pending():
+        return {'memberships': {}, 'user_rooms': {}, 'owners': {}, 'closed': set()}
+
+    def actor(self, room_pk):
+        actor = self.actors.get(room_pk)
+        # Actors only live as long as the event loop their task runs on
+        if actor is None or actor._task.get_loop() is not asyncio.get_event_loop():
+            actor = self.actors[room_pk] = RoomActor(self, room_pk)
+        return actor
+
+    async def create(self, room, user):
+        actor = self.actors[room.pk] = RoomActor(self, room.pk)
+        actor.owner_pk = room.user_id
+        actor.loaded = True
+        room.watchers_count = 0
+        change_logs.rooms.add(room.pk, RoomPreviewSerializer.to_dict(room))
+        await actor.call(lambda: actor.join(user))
+        return actor
+
+    async def join(self, room_pk, user):
+        actor = self.actor(room_pk)
+        await actor.call(lambda: actor.join(user))
+        return actor
+
+    async def leave(self, room_pk, user_pk):
+        actor = self.actor(room_pk)
+        return await actor.call(lambda: actor.leave(user_pk))
+
+    async def delete(self, room_pk, user_pk):
+        actor = self.actor(room_pk)
+        return await actor.call(lambda: actor.delete(user_pk))
+
+    def user_room(self, user_pk, default=None):
+        """The room of the user, including changes not written yet"""
+        return self._pending['user_rooms'].get(user_pk, default)
+
+    def record_join(self, room_pk, user_pk):
+        self._pending['memberships'][(room_pk, user_pk)] = True
+        self._pending['user_rooms'][user_pk] = room_pk
+        self._schedule()
+
+    def record_leave(self, room_pk, user_pk):
+        self._pending['memberships'][(room_pk, user_pk)] = False
+        if self._pending['user_rooms'].get(user_pk, room_pk) == room_pk:
+            self._pending['user_rooms'][user_pk] = None
+        self._schedule()
+
+    def record_owner(self, room_pk, user_pk):
+        self._pending['owners'][room_pk] = user_pk
+        self._schedule()
+
+    def record_close(self, room_pk):
+        drop_room(self._pending, room_pk)
+        self._pending['closed'].add(room_pk)
+        self.closed_rooms.add(room_pk)
+        self.actors.pop(room_pk, None)
+        self._schedule()
+
+    def _schedule(self, delay=None):
+        loop = asyncio.get_event_loop()
+        if self._flush_handle is not None and self._flush_loop is loop: return
+        self._flush_loop = loop
+        self._flush_handle = loop.call_later(delay or self.flush_interval, lambda: background(self.flush()))
+
+    async def flush(self):
+        if self._flush_handle is not None: self._flush_handle.cancel()
+        self._flush_handle = None
+        pending, self._pending = self._pending, self._empty_pending()
+        previous = self._writing
+        self._writing = background(self._write(previous, pending, change_logs.rooms.version))
+        await self._writing
+
+    def flush_now(self):
+        """Write the pending changes from the calling thread, used on shutdown when the event loop is gone"""
+        pending, self._pending = self._pending, self._empty_pending()
+        if pending != self._empty_pending(): write_rooms(pending)
+
+    async def _write(self, previous, pending, version):
+        # Batches are written one at a time so they reach the database in order, a failed one doesn't stop the next
+        if previous is not None and previous.get_loop() is asyncio.get_event_loop():
+            await asyncio.wait([previous])
+        try:
+            await s2as(write_rooms, critical=True)(pending)
+        except Exception:
+            logger.exception('Could not write the room changes, they will be retried')
+            self._requeue(pending)
+            return
+        self._failures = 0
+        self.closed_rooms -= pending['closed']
+        self.written_version = max(self.written_version, version)
+
+    def _requeue(self, failed):
+        """Put a batch that failed back in front of the pending changes, the changes recorded since win"""
+        pending = self._pending
+        for kind in ('memberships', 'user_rooms', 'owners'):
+            pending[kind] = {**failed[kind], **pending[kind]}
+        for room_pk in pending['closed']:
+            drop_room(pending, room_pk)
+        pending['closed'] |= failed['closed']
+        self._failures += 1
+        self._schedule(min(self.flush_interval * 2 ** self._failures, ROOMS_RETRY_MAX_DELAY))
+
+
+def drop_room(pending, room_pk):
+    """The room row goes away with its memberships, anything else pointing at it must not be written"""
+    pending['owners'].pop(room_pk, None)
+    for key in [key for key in pending['memberships'] if key[0] == room_pk]:
+        del pending['memberships'][key]
+    for user_pk, user_room in pending['user_rooms'].items():
+        if user_room == room_pk: pending['user_rooms'][user_pk] = None
+
+
+def write_rooms(pending):
+    """Write a batch of room changes, with one query per kind of change (and per room for the user rooms)"""
+    Watching = Room.users_watching.through
+    with transaction.atomic():
+        owners = pending['owners']
+        if owners:
+            Room.objects.filter(pk__in=owners).update(
+                user_id=Case(*[When(pk=room_pk, then=user_pk) for room_pk, user_pk in owners.items()]))
+
+        joined = [key for key, is_member in pending['memberships'].items() if is_member]
+        left = [key for key, is_member in pending['memberships'].items() if not is_member]
+        if joined:
+            Watching.objects.bulk_create([Watching(room_id=room_pk, user_id=user_pk) for room_pk, user_pk in joined],
+                                         ignore_conflicts=True)
+            Room.objects.filter(pk__in={room_pk for room_pk, _ in joined}).update(last_activity_at=timezone.now())
+        left_by_room = {}
+        for room_pk, user_pk in left:
+            left_by_room.setdefault(room_pk, []).append(user_pk)
+        for room_pk, user_pks in left_by_room.items():
+            Watching.objects.filter(room_id=room_pk, user_id__in=user_pks).delete()
+
+        users_by_room = {}
+        for user_pk, room_pk in pending['user_rooms'].items():
+            users_by_room.setdefault(room_pk, []).append(user_pk)
+        for room_pk, user_pks in users_by_room.items():
+            User.objects.filter(pk__in=user_pks).update(room_id=room_pk)
+
+        if pending['closed']:
+            Room.objects.filter(pk__in=pending['closed']).delete()
+
+
+rooms = RoomRegistry()
@@ -0,0 +1,81 @@
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+
+REPLICA = 'replica'
+# How long the reads of a connection stay on the primary after it wrote, longer than the replica usually lags
+REPLICA_PIN_SECONDS = 5
+# How far behind the primary the replica is taken to be, versioned snapshots read from it are dated that far back
+REPLICA_LAG = REPLICA_PIN_SECONDS
+
+# The pin of the websocket connection whose message is being handled, set by the dispatcher
+current_pin = ContextVar('current_pin', default=None)
+# Whether the handler running only reads, set by the dispatcher for the handlers marked `read_only`
+current_read_only = ContextVar('current_read_only', default=False)
+
+
+class Pin:
+    """Keeps the reads of a websocket connection on the primary for a while after its writes (read-your-writes)"""
+    __slots__ = ('until',)
+
+    def __init__(self):
+        self.until = 0.0
+
+    def wrote(self):
+        self.until = time.monotonic() + REPLICA_PIN_SECONDS
+
+    @property
+    def pinned(self):
+        return time.monotonic() < self.until
+
+
+def has_replica():
+    return REPLICA in settings.DATABASES
+
+
+def reads_from_replica():
+    """Whether the reads made now go to the replica"""
+    if not current_read_only.get() or not has_replica(): return False
+    pin = current_pin.get()
+    return pin is None or not pin.pinned
+
+
+def replica_lag():
+    """How far behind the database the reads made now go to may be"""
+    return REPLICA_LAG if reads_from_replica() else 0
+
+
+def pin_on_write(execute, sql, params, many, context):
+    # Pinned on the statements run rather than in db_for_write, that Django also asks when building unsaved models
+    pin = current_pin.get()
+    if pin is not None and sql.lstrip()[:6].upper() != 'SELECT': pin.wrote()
+    return execute(sql, params, many, context)
+
+
+def instrument_connection(connection, **kwargs):
+    if connection.alias == DEFAULT_DB_ALIAS and pin_on_write not in connection.execute_wrappers:
+        connection.execute_wrappers.append(pin_on_write)
+
+
+connection_created.connect(instrument_connection)
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of the read-only handlers to the replica when there is one, everything else to the primary.
+    A connection that wrote reads from the primary for the next REPLICA_PIN_SECONDS,
+    so what it just wrote is never missing from what it reads next.
+    """
+
+    def db_for_read(self, model, **hints):
+        return REPLICA if reads_from_replica() else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
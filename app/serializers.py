@@ -0,0 +1,243 @@
+from django.db.models import Count, Q, QuerySet, prefetch_related_objects
+
+from .friends import friend_graph
+from .models import User, Room, Message, Post, Comment
+from .pagination import encode_cursor
+
+COMMENTS_PREVIEW_SIZE = 3
+ROOM_MESSAGES_SIZE = 50
+
+
+def format_datetime(value):
+    return value.isoformat() if value else None
+
+
+class Latest:
+    """
+    The `size` newest rows (by created_at) of each parent, newest first, set as `to_attr` on the parents.
+    Each parent gets its own LIMIT subquery, a bounded read of the (parent, created_at, id) index,
+    and the subqueries of all the parents go in one query.
+    """
+
+    def __init__(self, model, parent, size, to_attr):
+        self.model = model
+        self.parent = parent
+        self.size = size
+        self.to_attr = to_attr
+
+    def load(self, parents):
+        if not parents: return
+        rows = self.model.objects.order_by('-created_at', '-id')
+        newest = Q()
+        for parent in parents:
+            newest |= Q(pk__in=rows.filter(**{self.parent: parent.pk}).values('pk')[:self.size])
+        loaded = {parent.pk: [] for parent in parents}
+        for row in rows.select_related('author').filter(newest):
+            loaded[getattr(row, f'{self.parent}_id')].append(row)
+        for parent in parents:
+            setattr(parent, self.to_attr, loaded[parent.pk])
+
+
+class Serializer:
+    """
+    Turns model instances into dicts in bulk.
+    Every relation `to_dict` walks must be listed in `select_related`, `prefetch_related`, `latest` or `annotations`
+    so that serializing a whole queryset costs a fixed number of queries.
+    """
+    model = None
+    select_related = ()
+    prefetch_related = ()
+    latest = ()
+    annotations = {}
+
+    @classmethod
+    def prepare(cls, queryset=None):
+        if queryset is None: queryset = cls.model.objects.all()
+        if cls.select_related: queryset = queryset.select_related(*cls.select_related)
+        if cls.prefetch_related: queryset = queryset.prefetch_related(*cls.prefetch_related)
+        if cls.annotations: queryset = queryset.annotate(**cls.annotations)
+        return queryset
+
+    @classmethod
+    def to_dict(cls, instance):
+        raise NotImplementedError
+
+    @classmethod
+    def many(cls, objects):
+        if isinstance(objects, QuerySet):
+            objects = list(cls.prepare(objects))
+        else:
+            objects = list(objects)
+            cls._load_relations(objects)
+        for relation in cls.latest:
+            relation.load(objects)
+        return [cls.to_dict(instance) for instance in objects]
+
+    @classmethod
+    def get(cls, **lookup):
+        objects = cls.many(cls.model.objects.filter(**lookup))
+        if not objects: raise cls.model.DoesNotExist
+        return objects[0]
+
+    @classmethod
+    def one(cls, instance):
+        # Fetch a fresh copy so long lived instances (like the user of a connection) never keep stale caches
+        return cls.get(pk=instance.pk)
+
+    @classmethod
+    def _load_relations(cls, objects):
+        if not objects: return
+        prefetch_related_objects(objects, *cls.select_related, *cls.prefetch_related)
+        for name, expression in cls.annotations.items():
+            missing = [instance.pk for instance in objects if not hasattr(instance, name)]
+            if not missing: continue
+            values = dict(cls.model.objects.filter(pk__in=missing)
+                          .annotate(**{name: expression}).values_list('pk', name))
+            for instance in objects:
+                if instance.pk in values: setattr(instance, name, values[instance.pk])
+
+
+class UserMinSerializer(Serializer):
+    model = User
+
+    @classmethod
+    def to_dict(cls, user):
+        return {
+            'name': user.name,
+            'is_online': user.is_online,
+            'id': user.pk
+        }
+
+
+class UserSerializer(Serializer):
+    """The friends come from the friend graph (app.friends), their rows are fetched in one query for all the users"""
+    model = User
+
+    @classmethod
+    def many(cls, objects):
+        users = list(objects)
+        friend_pks = friend_graph.friends_of([user.pk for user in users])
+        friends = User.objects.in_bulk(set().union(*friend_pks.values()))
+        for user in users:
+            user.friend_list = [friends[pk] for pk in sorted(friend_pks[user.pk]) if pk in friends]
+        return [cls.to_dict(user) for user in users]
+
+    @classmethod
+    def to_dict(cls, user):
+        return {
+            'name': user.name,
+            'email': user.email,
+            'is_online': user.is_online,
+            'friends': [UserMinSerializer.to_dict(friend) for friend in user.friend_list],
+            'id': user.pk
+        }
+
+
+class MessageSerializer(Serializer):
+    model = Message
+    select_related = ('author',)
+
+    @classmethod
+    def to_dict(cls, message):
+        return {
+            'message_text': message.message_text,
+            'created_at': format_datetime(message.created_at),
+            'author': UserMinSerializer.to_dict(message.author),
+            'id': message.pk
+        }
+
+
+class RoomPreviewSerializer(Serializer):
+    model = Room
+    select_related = ('user',)
+    annotations = {'watchers_count': Count('users_watching')}
+
+    @classmethod
+    def to_dict(cls, room):
+        return {
+            'name': room.name,
+            'number_of_users_watching': room.watchers_count,
+            'user': UserMinSerializer.to_dict(room.user),
+            'id': room.pk
+        }
+
+
+class RoomSerializer(Serializer):
+    """Rooms only carry their latest messages, older ones are paged with `room_history`"""
+    model = Room
+    select_related = ('user',)
+    prefetch_related = ('users_watching',)
+    latest = (Latest(Message, 'room', ROOM_MESSAGES_SIZE, 'latest_messages'),)
+    annotations = {'messages_count': Count('message')}
+
+    @classmethod
+    def to_dict(cls, room):
+        messages = room.latest_messages
+        messages_cursor = None
+        if room.messages_count > len(messages):
+            messages_cursor = encode_cursor([messages[-1].created_at, messages[-1].pk])
+        return {
+            'name': room.name,
+            'users_watching': [UserMinSerializer.to_dict(user) for user in room.users_watching.all()],
+            'user': UserMinSerializer.to_dict(room.user),
+            'messages': [MessageSerializer.to_dict(message) for message in reversed(messages)],
+            'messages_cursor': messages_cursor,
+            'id': room.pk
+        }
+
+    @classmethod
+    def add_buffered(cls, room, buffered):
+        """
+        Add the messages not written yet to the window of a serialized room, keeping it ROOM_MESSAGES_SIZE long.
+        The ones written since the window was read are already in it, with the same id or created_at
+        (unique in a room, see app.chat).
+        """
+        window = room['messages']
+        ids, created_ats = {message['id'] for message in window}, {message['created_at'] for message in window}
+        for message in map(MessageSerializer.to_dict, buffered):
+            if message['id'] in ids or message['created_at'] in created_ats: continue
+            window.append(message)
+        if len(window) <= ROOM_MESSAGES_SIZE: return
+        del window[:-ROOM_MESSAGES_SIZE]
+        # Buffered messages have no id yet, none of the messages of the room has the same created_at
+        room['messages_cursor'] = encode_cursor([window[0]['created_at'], window[0]['id'] or 0])
+
+
+class CommentSerializer(Serializer):
+    model = Comment
+    select_related = ('author',)
+
+    @classmethod
+    def to_dict(cls, comment):
+        return {
+            'author': UserMinSerializer.to_dict(comment.author),
+            'comment_text': comment.comment_text,
+            'created_at': format_datetime(comment.created_at),
+            'id': comment.pk
+        }
+
+
+class PostSerializer(Serializer):
+    """Posts only carry a preview of their comments, the rest is paged with `get_comments`"""
+    model = Post
+    select_related = ('author',)
+    prefetch_related = ('likes',)
+    latest = (Latest(Comment, 'post', COMMENTS_PREVIEW_SIZE, 'preview_comments'),)
+    annotations = {'comments_count': Count('comment')}
+
+    @classmethod
+    def to_dict(cls, post):
+        comments = post.preview_comments
+        comments_cursor = None
+        if post.comments_count > len(comments):
+            comments_cursor = encode_cursor([comments[-1].created_at, comments[-1].pk])
+        return {
+            'author': UserMinSerializer.to_dict(post.author),
+            'post_text': post.post_text,
+            'posted_at': format_datetime(post.posted_at),
+            'likes': [UserMinSerializer.to_dict(like) for like in post.likes.all()],
+            'comments': [CommentSerializer.to_dict(comment) for comment in comments],
+            'comments_count': post.comments_count,
+            'comments_cursor': comments_cursor,
+            'id': post.pk
+        }
@@ -0,0 +1,25 @@
+from django.conf import settings
+
+REDIS_LAYERS = ('channels_redis.core.RedisChannelLayer', 'app.layers.HybridChannelLayer')
+
+
+def redis_address():
+    """The redis of the channel layer, None when the layer keeps everything in memory"""
+    layer = settings.CHANNEL_LAYERS['default']
+    if layer['BACKEND'] not in REDIS_LAYERS:
+        return None
+    return layer['CONFIG']['hosts'][0]
+
+
+class RedisConnection:
+    """A redis pool created on first use, from async code"""
+
+    def __init__(self, address):
+        self.address = address
+        self._pool = None
+
+    async def get(self):
+        if self._pool is None:
+            import aioredis
+            self._pool = await aioredis.create_redis_pool(self.address)
+        return self._pool
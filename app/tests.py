@@ -1,3 +1,1032 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .changes import ChangeLog
+from .chat import ChatBuffer
+from .consumers import GlobalConsumer
+from .database import DatabaseExecutor, DatabaseTimeout, database_sync_to_async as s2as
+from .directory import user_directory
+from .dispatch import DispatchMixin, HandlerStats, InvalidPayload, compile_schema, optional, ID
+from .friends import friend_graph
+from .groups import user_group
+from .hashing import PasswordHashing, ServerBusy, password_hashing
+from .layers import HybridChannelLayer, GROUP_MEMBERS_LUA
+from .managers import token_key
+from .metrics import GROUP_FANOUT, current_handler
+from .models import User, Token, Room, Message
+from .pagination import encode_cursor, decode_cursor
+from .playback import MemoryPlaybackStore, playback
+from .presence import MemoryPresenceStore, Presence
+from .protocol import MSGPACK, binary_frame, format_message_binary, group_frame
+from .rooms import RoomRegistry, rooms
+from .routers import ReplicaRouter, Pin, current_pin, current_read_only, pin_on_write
+from .routing import application
+from .serializers import RoomSerializer, ROOM_MESSAGES_SIZE
+from .token_cache import TokenCache, token_cache
+
+
+@override_settings(
+    DEBUG=True,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']
+)
+class QueryBudgetTest(TransactionTestCase):
+    """The handlers with a query budget stay within it, whatever the size of what they return"""
+    databases = '__all__'
+
+    def populate(self, size):
+        """A user with `size` times the friends, posts, likes, comments, rooms and messages, their token and a room"""
+        first = User.objects.count()
+        users = [User.objects.create_user(email=f'user{first + i}@example.com', name=f'User {first + i}',
+                                          password='secret') for i in range(1 + 5 * size)]
+        user, friends, others = users[0], users[1:1 + 3 * size], users[1 + 3 * size:]
+        for friend in friends:
+            user.add_friend(friend.pk)
+        # The friends of friends to suggest
+        for friend, other in zip(friends, others):
+            friend.add_friend(other.pk)
+        for i, author in enumerate(users):
+            post = author.create_post(f'Post {i}')
+            for other in friends:
+                other.like_post(post.pk)
+                other.comment_post(post.pk, f'Comment on post {i}')
+
+        for i, owner in enumerate(friends):
+            room = Room.objects.create(name=f'Room {i}', video_url='https://example.com/video', user=owner)
+            room.users_watching.add(owner, others[i % len(others)])
+            Message.objects.bulk_create([Message(author=owner, room=room, message_text=f'Message {j}')
+                                         for j in range(10 * size)])
+        return User.objects.authenticate(user.email, 'secret')['token'], room
+
+    def queries(self, size):
+        """The most queries each handler made, for a user with data of `size`, starting with cold caches"""
+        token, room = self.populate(size)
+        rooms.reset()
+        friend_graph.clear()
+        user_directory.reset()
+        dispatcher = GlobalConsumer.dispatcher
+        for type in dispatcher.budgets:
+            dispatcher.stats[type] = HandlerStats()
+        asyncio.run(self.exercise(token, room))
+        return {type: dispatcher.stats[type].max_queries for type in dispatcher.budgets}
+
+    def tearDown(self):
+        rooms.reset()
+        friend_graph.clear()
+        user_directory.reset()
+
+    async def request(self, communicator, type, data=None):
+        await communicator.send_to(text_data=json.dumps({'type': type, 'data': data}))
+        replies = {'get_posts': 'posts', 'join_room': 'join_room_success'}
+        while True:
+            reply = json.loads(await communicator.receive_from(2))
+            if reply['type'] in (replies.get(type, type), f'{type}_error', 'error'):
+                self.assertEqual(reply['type'], replies.get(type, type), reply)
+                return reply['data']
+
+    async def exercise(self, token, room):
+        communicator = WebsocketCommunicator(application, '/' + token)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        for type, data in [('rooms', None), ('rooms', {'sort': 'watchers'}), ('users', {'limit': 2}),
+                           ('get_posts', None), ('profile', None), ('join_room', {'id': room.pk}),
+                           ('join_room', {'id': room.pk}), ('friends', None), ('mutual_friends', {'id': room.user_id}),
+                           ('suggested_friends', None), ('search_users', {'query': 'user'}),
+                           ('search_users', {'query': 'ser 1'})]:
+            await self.request(communicator, type, data)
+        await communicator.disconnect()
+
+    def test_handlers_stay_within_their_query_budget(self):
+        queries = self.queries(1)
+        for type, budget in GlobalConsumer.dispatcher.budgets.items():
+            with self.subTest(type=type):
+                self.assertIsNotNone(queries[type], f'The {type} handler was not exercised')
+                self.assertLessEqual(queries[type], budget,
+                                     f'The {type} handler made {queries[type]} queries, its budget is {budget}')
+
+    def test_queries_dont_grow_with_the_data(self):
+        self.assertEqual(self.queries(1), self.queries(3))
+
+
+@mock.patch('app.routers.has_replica', return_value=True)
+class ReplicaRouterTest(SimpleTestCase):
+    """The read-only handlers read from the replica, unless their connection wrote recently"""
+
+    def route(self, pin, read_only=True, sql=None):
+        pin_token, read_only_token = current_pin.set(pin), current_read_only.set(read_only)
+        try:
+            if sql: pin_on_write(lambda *args: None, sql, (), False, {})
+            return ReplicaRouter().db_for_read(User)
+        finally:
+            current_pin.reset(pin_token)
+            current_read_only.reset(read_only_token)
+
+    def test_read_only_handlers_read_from_the_replica(self, has_replica):
+        self.assertEqual(self.route(Pin()), 'replica')
+        self.assertEqual(self.route(Pin(), read_only=False), 'default')
+
+    def test_connections_read_their_writes(self, has_replica):
+        pin = Pin()
+        self.assertEqual(self.route(pin, sql='SELECT 1'), 'replica')
+        self.assertEqual(self.route(pin, sql='UPDATE "app_user" SET "is_online" = 1'), 'default')
+        self.assertEqual(self.route(pin), 'default')
+        self.assertEqual(self.route(Pin()), 'replica')
+
+        pin.until = 0.0
+        self.assertEqual(self.route(pin), 'replica')
+
+    def test_everything_goes_to_the_primary_without_a_replica(self, has_replica):
+        has_replica.return_value = False
+        self.assertEqual(self.route(Pin()), 'default')
+
+
+class CursorTest(SimpleTestCase):
+    """Cursors come from clients, the malformed ones are rejected as invalid"""
+
+    def test_values_of_the_wrong_type_are_invalid(self):
+        for values in ([5, 1], ['2020-01-01T00:00:00+00:00', '1'], ['2020-01-01T00:00:00+00:00', True],
+                       ['2020-13-45T00:00:00', 1], ['2020-01-01T00:00:00+00:00']):
+            with self.subTest(values=values), self.assertRaisesMessage(ValueError, 'Invalid cursor'):
+                decode_cursor(encode_cursor(values), Room, ('created_at', 'id'))
+
+    def test_valid_cursors_are_decoded(self):
+        created_at, pk = decode_cursor(encode_cursor(['2020-01-01T00:00:00+00:00', 3]), Room, ('created_at', 'id'))
+        self.assertEqual((created_at.year, pk), (2020, 3))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PasswordChangeTest(TestCase):
+    """Changing a password logs the user out of every device"""
+
+    def test_tokens_are_revoked_when_the_password_changes(self):
+        user = User.objects.create_user(email='user@example.com', password='secret')
+        token = User.objects.authenticate(user.email, 'secret')['token']
+        self.assertIsNotNone(User.objects.authenticate_with_jwt(token))
+
+        user.set_password('another secret')
+        user.save()
+        self.assertIsNone(User.objects.authenticate_with_jwt(token))
+        self.assertFalse(Token.objects.filter(user=user).exists())
+
+
+class TokenCacheTest(TestCase):
+    """Verified tokens are cached for a while, and forgotten as soon as they are revoked"""
+
+    def test_hits_and_misses(self):
+        cache = TokenCache()
+        self.assertIsNone(cache.get('token'))
+        cache.set('token', 1)
+        self.assertEqual(cache.get('token'), 1)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_entries_expire(self):
+        cache = TokenCache(ttl=60)
+        with mock.patch('app.token_cache.time.monotonic', return_value=1000):
+            cache.set('token', 1)
+            # Never kept past the expiry of the token itself
+            cache.set('expiring', 2, expires_in=10)
+            cache.set('expired', 3, expires_in=0)
+        with mock.patch('app.token_cache.time.monotonic', return_value=1011):
+            self.assertEqual(cache.get('token'), 1)
+            self.assertIsNone(cache.get('expiring'))
+            self.assertIsNone(cache.get('expired'))
+        with mock.patch('app.token_cache.time.monotonic', return_value=1060):
+            self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_the_least_recently_used_entries_are_evicted(self):
+        cache = TokenCache(max_size=2)
+        cache.set('first', 1)
+        cache.set('second', 2)
+        cache.get('first')
+        cache.set('third', 3)
+        self.assertEqual([cache.get(token) for token in ('first', 'second', 'third')], [1, None, 3])
+
+    def test_revoked_tokens_are_forgotten(self):
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+        user = User.objects.create_user(email='user@example.com', password='secret')
+        token, other, changed = (User.objects.authenticate(user.email, 'secret')['token'] for _ in range(3))
+        for cached in (token, other, changed):
+            User.objects.authenticate_with_jwt(cached)
+            self.assertEqual(token_cache.get(cached), user.pk)
+
+        Token.objects.revoke(token)
+        self.assertIsNone(token_cache.get(token))
+        self.assertEqual(token_cache.get(other), user.pk)
+        user.set_password('another secret')
+        user.save()
+        self.assertIsNone(token_cache.get(other))
+        self.assertIsNone(token_cache.get(changed))
+
+
+class UserDirectoryTest(TestCase):
+    """The directory finds users by name or whole email, and picks up the ones saved by the other processes"""
+
+    def setUp(self):
+        user_directory.reset()
+        self.addCleanup(user_directory.reset)
+
+    def test_renamed_users_are_found_under_their_new_name(self):
+        user = User.objects.create_user(email='john@example.com', name='John', password='secret')
+        self.assertEqual(user_directory.search('john'), ([user.pk], None))
+        # Saved elsewhere, the signals of this process don't see it
+        User.objects.filter(pk=user.pk).update(name='Mary', email='mary@example.com', updated_at=timezone.now())
+        user_directory._refreshed_at = 0.0
+        self.assertEqual(user_directory.search('mary'), ([user.pk], None))
+        self.assertEqual(user_directory.search('john'), ([], None))
+
+    def test_emails_are_only_found_whole(self):
+        user = User.objects.create_user(email='mary@example.com', name='Someone', password='secret')
+        for partial in ('m', 'mary', 'mary@', 'mary@example'):
+            with self.subTest(query=partial):
+                self.assertEqual(user_directory.search(partial), ([], None))
+        self.assertEqual(user_directory.search('Mary@Example.com'), ([user.pk], None))
+
+
+class FriendGraphTest(TestCase):
+    """Mutual friends and suggestions come from the friend sets, kept up to date by the friendships made here"""
+
+    def setUp(self):
+        friend_graph.clear()
+        self.addCleanup(friend_graph.clear)
+        self.me, self.ann, self.bob, self.cat, self.dan, self.eve = (
+            User.objects.create_user(email=f'{name}@example.com', name=name, password='secret')
+            for name in ('me', 'ann', 'bob', 'cat', 'dan', 'eve')
+        )
+        for user, friends in ((self.me, (self.ann, self.bob)), (self.ann, (self.cat, self.dan)),
+                              (self.bob, (self.cat, self.eve))):
+            for friend in friends:
+                user.add_friend(friend.pk)
+
+    def test_mutual_friends(self):
+        self.assertEqual(friend_graph.mutual(self.ann.pk, self.bob.pk), {self.me.pk, self.cat.pk})
+        self.assertEqual(friend_graph.mutual(self.me.pk, self.cat.pk), {self.ann.pk, self.bob.pk})
+        self.assertEqual(friend_graph.mutual(self.dan.pk, self.eve.pk), frozenset())
+
+    def test_suggestions_are_friends_of_friends_by_mutual_count(self):
+        # Ann and Bob have me in common but are already my friends, and I'm never suggested to myself
+        expected = [(self.cat.pk, 2), (self.dan.pk, 1), (self.eve.pk, 1)]
+        self.assertEqual(friend_graph.suggestions(self.me.pk), expected)
+        self.assertEqual(friend_graph.suggestions(self.me.pk, limit=2), expected[:2])
+
+    def test_friendships_made_here_update_the_suggestions(self):
+        friend_graph.suggestions(self.me.pk)
+        self.me.add_friend(self.cat.pk)
+        friend_graph.add(self.me.pk, self.cat.pk)
+        self.assertEqual(friend_graph.suggestions(self.me.pk), [(self.dan.pk, 1), (self.eve.pk, 1)])
+        self.assertEqual(friend_graph.mutual(self.me.pk, self.ann.pk), {self.cat.pk})
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']
+)
+class LoginTest(TransactionTestCase):
+    """Logging in checks the password once, in the hashing pool, and failures are answered with login_error"""
+
+    def setUp(self):
+        User.objects.create_user(email='user@example.com', password='secret')
+
+    async def log_in(self, email, password):
+        communicator = WebsocketCommunicator(application, '/auth')
+        await communicator.connect()
+        login = {'type': 'login', 'data': {'email': email, 'password': password}}
+        await communicator.send_to(text_data=json.dumps(login))
+        reply = json.loads(await communicator.receive_from(2))
+        await communicator.disconnect()
+        return reply
+
+    def test_the_password_is_checked_once(self):
+        with mock.patch.object(password_hashing, 'check', mock.AsyncMock(return_value=True)) as check, \
+                mock.patch('app.managers.check_password') as check_in_process:
+            reply = asyncio.run(self.log_in('user@example.com', 'secret'))
+        self.assertEqual(reply['type'], 'login_success')
+        check.assert_awaited_once()
+        check_in_process.assert_not_called()
+
+    def test_failures_are_login_errors(self):
+        busy = PasswordHashing(queue_limit=0)
+        with mock.patch('app.consumers.password_hashing', busy):
+            reply = asyncio.run(self.log_in('user@example.com', 'secret'))
+        self.assertEqual(reply, {'type': 'login_error', 'data': 'The server is busy, try again in a moment'})
+        reply = asyncio.run(self.log_in('', 'secret'))
+        self.assertEqual(reply, {'type': 'login_error', 'data': 'You must provide an email'})
+
+
+class TokenTest(TestCase):
+    """Tokens authenticate their user until they expire or are revoked"""
+
+    def setUp(self):
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+        self.user = User.objects.create_user(email='user@example.com', password='secret')
+
+    def authenticates(self, token):
+        result = User.objects.authenticate_with_jwt(token)
+        return result is not None and result['user'] == self.user
+
+    def test_issued_tokens_authenticate_until_they_expire(self):
+        self.assertTrue(self.authenticates(Token.objects.issue(self.user)))
+        self.assertFalse(self.authenticates(Token.objects.issue(self.user, lifetime=timedelta(seconds=-1))))
+        self.assertFalse(self.authenticates('not a token'))
+
+    def test_revoked_tokens_dont_authenticate(self):
+        token, other = Token.objects.issue(self.user), Token.objects.issue(self.user)
+        # Cached by the first use
+        self.assertTrue(self.authenticates(token))
+        Token.objects.revoke(token)
+        self.assertFalse(self.authenticates(token))
+        self.assertTrue(self.authenticates(other))
+
+        Token.objects.revoke_all(self.user)
+        self.assertFalse(self.authenticates(other))
+        self.assertFalse(Token.objects.filter(user=self.user).exists())
+
+    def test_expired_tokens_are_deleted_by_the_command(self):
+        valid = Token.objects.issue(self.user)
+        Token.objects.create(user=self.user, key='expired', expires_at=timezone.now() - timedelta(days=1))
+        out = StringIO()
+        call_command('delete_expired_tokens', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Deleted 1 expired tokens')
+        self.assertEqual(list(Token.objects.values_list('key', flat=True)), [token_key(valid)])
+
+
+class TokenMigrationTest(TransactionTestCase):
+    """The tokens kept in a json list on the users become hashed rows of their own"""
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([target])
+        return executor.loader.project_state([target]).apps
+
+    def test_legacy_tokens_are_moved(self):
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes('app')[0]
+        self.addCleanup(self.migrate, latest)
+        apps = self.migrate(('app', '0017_auto_20261017_2040'))
+        legacy_user = apps.get_model('app', 'User')
+        user = legacy_user.objects.create(email='user@example.com', tokens=json.dumps(['a', 'b', 'a']))
+
+        apps = self.migrate(('app', '0018_token'))
+        tokens = apps.get_model('app', 'Token').objects.filter(user_id=user.pk)
+        self.assertEqual(sorted(tokens.values_list('key', flat=True)), sorted([token_key('a'), token_key('b')]))
+        self.assertTrue(all(token.expires_at > timezone.now() for token in tokens))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PresenceTest(TransactionTestCase):
+    """Friends are told when a user goes online, and offline once they stayed away for the grace period"""
+
+    def setUp(self):
+        friend_graph.clear()
+        self.addCleanup(friend_graph.clear)
+        self.user, self.friend, self.stranger = (User.objects.create(email=f'{name}@example.com', name=name)
+                                                 for name in ('user', 'friend', 'stranger'))
+        self.user.add_friend(self.friend.pk)
+        self.now = 1000.0
+        clock = mock.patch('app.presence.time', mock.Mock(monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    async def listen(self, layer, presence, user):
+        """Connect the user and return the channel of the connection, in the group of the user"""
+        channel = await layer.new_channel()
+        await layer.group_add(user_group(user.pk), channel)
+        await presence.store.add(user.pk, channel)
+        return channel
+
+    async def updates(self, layer, channel):
+        updates = []
+        while True:
+            try:
+                message = await asyncio.wait_for(layer.receive(channel), 0.05)
+            except asyncio.TimeoutError:
+                return updates
+            updates += json.loads(message['text'])['data']['users']
+
+    async def at(self, now, presence):
+        self.now = now
+        await presence.flush()
+
+    def test_quick_reconnections_are_not_published(self):
+        async def test():
+            layer = get_channel_layer()
+            # Flushed by the test only
+            presence = Presence(MemoryPresenceStore(), flush_interval=100, offline_grace=5)
+            friend = await self.listen(layer, presence, self.friend)
+            stranger = await self.listen(layer, presence, self.stranger)
+            await presence.connect(self.user.pk, 'connection')
+            await self.at(1001, presence)
+            self.assertEqual(await self.updates(layer, friend), [{'id': self.user.pk, 'is_online': True}])
+            self.assertEqual(await self.updates(layer, stranger), [])
+
+            # Back within the grace period
+            await presence.disconnect(self.user.pk, 'connection')
+            await self.at(1003, presence)
+            await presence.connect(self.user.pk, 'another connection')
+            await self.at(1010, presence)
+            self.assertEqual(await self.updates(layer, friend), [])
+
+            await presence.disconnect(self.user.pk, 'another connection')
+            await self.at(1014, presence)
+            self.assertEqual(await self.updates(layer, friend), [])
+            await self.at(1016, presence)
+            self.assertEqual(await self.updates(layer, friend), [{'id': self.user.pk, 'is_online': False}])
+            self.assertEqual(await self.updates(layer, stranger), [])
+            self.assertFalse(await s2as(User.objects.filter(pk=self.user.pk, is_online=True).exists)())
+
+        asyncio.run(test())
+
+
+class DispatchTest(SimpleTestCase):
+    """Malformed messages are answered with an error frame rather than failing the consumer"""
+
+    class Consumer(DispatchMixin):
+        dispatcher = GlobalConsumer.dispatcher
+
+        def __init__(self):
+            self.frames = []
+
+        async def send_frame(self, type, data):
+            self.frames.append((type, data))
+
+    def test_message_types_must_be_strings(self):
+        consumer = self.Consumer()
+        for message in ({'type': ['x']}, {'type': {'a': 1}}, {'type': 1}):
+            asyncio.run(consumer.receive(text_data=json.dumps(message)))
+        self.assertEqual(consumer.frames, [('error', 'Invalid message')] * 3)
+
+    def test_group_frames_are_only_encoded_in_msgpack_for_msgpack_recipients(self):
+        message = group_frame('presence', {'users': [{'id': 1, 'is_online': True}]})
+        self.assertNotIn('bytes', message)
+        consumer = self.Consumer()
+        consumer.protocol = MSGPACK
+        sent = []
+
+        async def send_encoded(text_data=None, bytes_data=None):
+            sent.append(bytes_data)
+
+        consumer.send_encoded = send_encoded
+        binary_frame.cache_clear()
+        for _ in range(3):
+            asyncio.run(consumer.websocket_send(message))
+        self.assertEqual(sent, [format_message_binary('presence', {'users': [{'id': 1, 'is_online': True}]})] * 3)
+        self.assertEqual(binary_frame.cache_info().misses, 1)
+
+    def test_ids_are_numbers(self):
+        validate = compile_schema({'id': ID, 'limit': optional(ID)})
+        self.assertEqual(validate({'id': 5}), {'id': 5})
+        self.assertEqual(validate({'id': '5', 'limit': 3}), {'id': 5, 'limit': 3})
+        for id in ('abc', '', True, 0, -1, 1.5, [1]):
+            with self.subTest(id=id), self.assertRaisesMessage(InvalidPayload, 'The field id is invalid'):
+                validate({'id': id})
+
+
+class RoomRegistryTest(TransactionTestCase):
+    """The registry keeps no actor for rooms it can't load, and retries the writes that failed"""
+
+    def setUp(self):
+        self.user = User.objects.create(email='user@example.com')
+        self.room = Room.objects.create(name='Room', video_url='https://example.com/video', user=self.user)
+
+    async def join_unknown_rooms(self, registry):
+        for room_pk in range(self.room.pk + 1, self.room.pk + 20):
+            with self.assertRaises(Room.DoesNotExist):
+                await registry.join(room_pk, self.user)
+        await asyncio.sleep(0)
+
+    def test_unknown_rooms_keep_no_actor(self):
+        registry = RoomRegistry()
+        asyncio.run(self.join_unknown_rooms(registry))
+        self.assertEqual(registry.actors, {})
+
+    async def join_and_flush(self, registry):
+        await registry.join(self.room.pk, self.user)
+        await registry.flush()
+        await registry.flush()
+
+    def test_failed_writes_are_retried(self):
+        registry = RoomRegistry()
+        with mock.patch('app.rooms.write_rooms', side_effect=[RuntimeError('database down'), None]) as write_rooms:
+            asyncio.run(self.join_and_flush(registry))
+        self.assertEqual(write_rooms.call_count, 2)
+        self.assertEqual(write_rooms.call_args[0][0]['memberships'], {(self.room.pk, self.user.pk): True})
+
+
+class ChatBufferTest(TransactionTestCase):
+    """Buffered messages are written even after a failed batch, and joined to the window of their room once"""
+
+    def setUp(self):
+        self.user = User.objects.create(email='user@example.com')
+        self.room = Room.objects.create(name='Room', video_url='https://example.com/video', user=self.user)
+
+    async def add(self, buffer, texts):
+        return [buffer.add(self.user, self.room.pk, text) for text in texts]
+
+    def written(self, write_messages):
+        return [[message.message_text for message in call[0][0]] for call in write_messages.call_args_list]
+
+    def test_failed_writes_are_retried_before_the_next_batches(self):
+        buffer = ChatBuffer(flush_interval=0.01)
+
+        async def send_and_flush():
+            buffer.add(self.user, self.room.pk, 'Message 0')
+            first = asyncio.ensure_future(buffer.flush())
+            await asyncio.sleep(0)
+            # The second batch is queued while the first one is failing
+            buffer.add(self.user, self.room.pk, 'Message 1')
+            await asyncio.gather(first, buffer.flush())
+
+        with mock.patch('app.chat.write_messages', side_effect=[RuntimeError('database down'), None, None]) \
+                as write_messages:
+            asyncio.run(send_and_flush())
+        self.assertEqual(self.written(write_messages), [['Message 0'], ['Message 0'], ['Message 1']])
+        self.assertEqual(buffer.buffered(self.room.pk), [])
+
+    def test_batches_are_written_outside_the_context_of_the_handlers(self):
+        buffer = ChatBuffer(flush_interval=0.01)
+        contexts = []
+
+        async def handle():
+            current_handler.set('send_message')
+            current_pin.set(Pin())
+            buffer.add(self.user, self.room.pk, 'Message 0')
+            await asyncio.sleep(0.1)
+
+        with mock.patch('app.chat.write_messages',
+                        side_effect=lambda messages: contexts.append((current_handler.get(), current_pin.get()))):
+            asyncio.run(handle())
+        self.assertEqual(contexts, [(None, None)])
+
+    def test_batches_being_written_are_written_on_shutdown(self):
+        buffer = ChatBuffer(flush_interval=0.1)
+
+        async def fail_and_stop():
+            buffer.add(self.user, self.room.pk, 'Message 0')
+            asyncio.ensure_future(buffer.flush())
+            await asyncio.sleep(0.05)
+            buffer.add(self.user, self.room.pk, 'Message 1')
+
+        with mock.patch('app.chat.write_messages', side_effect=[RuntimeError('database down'), None]) \
+                as write_messages:
+            # The loop stops while the first batch waits for its retry
+            asyncio.run(fail_and_stop())
+            buffer.flush_now()
+        self.assertEqual(self.written(write_messages), [['Message 0'], ['Message 0', 'Message 1']])
+
+    def test_buffered_messages_join_the_window_once(self):
+        buffer = ChatBuffer()
+        written = asyncio.run(self.add(buffer, [f'Message {i}' for i in range(ROOM_MESSAGES_SIZE)]))
+        Message.objects.bulk_create(written)
+        room = RoomSerializer.get(pk=self.room.pk)
+        self.assertIsNone(room['messages_cursor'])
+
+        # Written but still in the buffer, and not written yet
+        buffered = written[-2:] + asyncio.run(self.add(buffer, [f'New {i}' for i in range(3)]))
+        RoomSerializer.add_buffered(room, buffered)
+        texts = [message['message_text'] for message in room['messages']]
+        self.assertEqual(len(texts), ROOM_MESSAGES_SIZE)
+        self.assertEqual(texts[-5:], [f'Message {ROOM_MESSAGES_SIZE - 2}', f'Message {ROOM_MESSAGES_SIZE - 1}',
+                                      'New 0', 'New 1', 'New 2'])
+        older, _ = Message.objects.page(self.room.pk, room['messages_cursor'])
+        self.assertEqual([message.message_text for message in older], ['Message 2', 'Message 1', 'Message 0'])
+
+
+class RoomsDeltaTest(SimpleTestCase):
+    """The rooms deltas of a connection only cover the rooms it listed, and the new ones on top of its sort"""
+
+    def changes(self, sort, listed):
+        consumer = GlobalConsumer({'type': 'websocket'})
+        consumer.rooms_sort, consumer.listed_rooms = sort, set(listed)
+        changes = [{'op': 'update', 'id': 1, 'item': {}}, {'op': 'update', 'id': 2, 'item': {}},
+                   {'op': 'add', 'id': 3, 'item': {}}, {'op': 'remove', 'id': 1}, {'op': 'remove', 'id': 4}]
+        return [(change['op'], change['id']) for change in consumer.listed_changes(changes)], consumer.listed_rooms
+
+    def test_deltas_follow_the_listing(self):
+        self.assertEqual(self.changes('recent', {1}), ([('update', 1), ('add', 3), ('remove', 1)], {3}))
+        self.assertEqual(self.changes('watchers', {1}), ([('update', 1), ('remove', 1)], set()))
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']
+)
+class ConsumerTest(TransactionTestCase):
+    """Connections of users talking to the GlobalConsumer"""
+
+    def setUp(self):
+        self.store = MemoryPlaybackStore()
+        patcher = mock.patch.object(playback, '_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(rooms.reset)
+
+    def user(self, name):
+        return User.objects.create_user(email=f'{name.lower()}@example.com', name=name, password='secret')
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(application, '/' + await s2as(Token.objects.issue)(user))
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await self.receive(communicator, 'profile')
+        return communicator
+
+    async def send(self, communicator, type, data=None):
+        await communicator.send_to(text_data=json.dumps({'type': type, 'data': data}))
+
+    async def receive(self, communicator, type):
+        """The data of the next frame of this type, the frames of other types before it are skipped"""
+        while True:
+            frame = json.loads(await communicator.receive_from(2))
+            if frame['type'] == type: return frame['data']
+
+    async def received(self, communicator):
+        """The types of the frames received until the connection goes quiet"""
+        types = []
+        while not await communicator.receive_nothing(0.1):
+            types.append(json.loads(await communicator.receive_from())['type'])
+        return types
+
+
+class RoomPlaybackTest(ConsumerTest):
+    """The members of a room share its playback, which goes away with the room"""
+
+    def test_playback_is_shared_by_the_members(self):
+        owner, member = self.user('Owner'), self.user('Member')
+
+        async def test():
+            owner_connection, member_connection = await self.connect(owner), await self.connect(member)
+            await self.send(owner_connection, 'create_room', {'videoURL': 'https://example.com/video', 'name': 'Room'})
+            room_pk = (await self.receive(owner_connection, 'create_room_success'))['room']['id']
+            await self.send(member_connection, 'join_room', {'id': room_pk})
+            self.assertEqual((await self.receive(member_connection, 'join_room_success'))['playback']['status'],
+                             'paused')
+
+            await self.send(owner_connection, 'play', {'position': 10})
+            for connection in (owner_connection, member_connection):
+                state = await self.receive(connection, 'playback')
+                self.assertEqual((state['room'], state['status'], state['position']), (room_pk, 'playing', 10))
+            await self.send(member_connection, 'seek', {'position': -1})
+            self.assertEqual(await self.receive(member_connection, 'seek_error'),
+                             'The position must be a positive number')
+            await self.send(member_connection, 'playback')
+            self.assertGreaterEqual((await self.receive(member_connection, 'playback'))['position'], 10)
+
+            # The room closes when its last member leaves, its playback with it
+            for connection in (owner_connection, member_connection):
+                await self.send(connection, 'leave_room')
+                await self.receive(connection, 'leave_room_success')
+            self.assertNotIn(room_pk, self.store._states)
+            for connection in (owner_connection, member_connection):
+                await connection.disconnect()
+
+        asyncio.run(test())
+
+    def test_time_sync(self):
+        user = self.user('User')
+
+        async def test():
+            connection = await self.connect(user)
+            await self.send(connection, 'time_sync', {'client_time': 123.5})
+            reply = await self.receive(connection, 'time_sync')
+            self.assertEqual(reply['client_time'], 123.5)
+            self.assertLessEqual(reply['server_receive_time'], reply['server_send_time'])
+            await self.send(connection, 'time_sync', {'client_time': 'now'})
+            self.assertEqual(await self.receive(connection, 'time_sync_error'), 'The field client_time is invalid')
+            await connection.disconnect()
+
+        asyncio.run(test())
+
+    def test_members_subscribed_to_the_rooms_are_told_of_a_deletion_once(self):
+        owner, member = self.user('Owner'), self.user('Member')
+
+        async def test():
+            owner_connection, member_connection = await self.connect(owner), await self.connect(member)
+            await self.send(owner_connection, 'create_room', {'videoURL': 'https://example.com/video', 'name': 'Room'})
+            room_pk = (await self.receive(owner_connection, 'create_room_success'))['room']['id']
+            await self.send(member_connection, 'join_room', {'id': room_pk})
+            await self.receive(member_connection, 'join_room_success')
+            await self.send(member_connection, 'subscribe', {'topic': 'rooms'})
+            await self.receive(member_connection, 'subscribe_success')
+            await self.send(owner_connection, 'play')
+            await self.receive(member_connection, 'playback')
+
+            await self.send(owner_connection, 'delete_room')
+            await self.receive(owner_connection, 'delete_room_success')
+            self.assertEqual((await self.received(member_connection)).count('room_deleted'), 1)
+            self.assertNotIn(room_pk, self.store._states)
+            for connection in (owner_connection, member_connection):
+                await connection.disconnect()
+
+        asyncio.run(test())
+
+
+class SubscriptionTest(ConsumerTest):
+    """Connections get the updates of the topics they subscribed to, until they unsubscribe"""
+
+    def test_room_creations_go_to_the_subscribers(self):
+        owner, watcher = self.user('Owner'), self.user('Watcher')
+
+        async def create_room(connection, name):
+            await self.send(connection, 'create_room', {'videoURL': 'https://example.com/video', 'name': name})
+            await self.receive(connection, 'create_room_success')
+
+        async def test():
+            owner_connection, watcher_connection = await self.connect(owner), await self.connect(watcher)
+            await self.send(watcher_connection, 'subscribe', {'topic': 'rooms'})
+            self.assertEqual(await self.receive(watcher_connection, 'subscribe_success'), {'topic': 'rooms'})
+            await create_room(owner_connection, 'First')
+            self.assertEqual((await self.receive(watcher_connection, 'room_created'))['room']['name'], 'First')
+
+            await self.send(watcher_connection, 'unsubscribe', {'topic': 'rooms'})
+            self.assertEqual(await self.receive(watcher_connection, 'unsubscribe_success'), {'topic': 'rooms'})
+            await create_room(owner_connection, 'Second')
+            self.assertNotIn('room_created', await self.received(watcher_connection))
+            for connection in (owner_connection, watcher_connection):
+                await connection.disconnect()
+
+        asyncio.run(test())
+
+    def test_unknown_topics_are_refused(self):
+        user = self.user('User')
+
+        async def test():
+            connection = await self.connect(user)
+            for type in ('subscribe', 'unsubscribe'):
+                with self.subTest(type=type):
+                    await self.send(connection, type, {'topic': 'users'})
+                    self.assertEqual(await self.receive(connection, f'{type}_error'), 'Unknown topic users')
+            await self.send(connection, 'subscribe', {'topic': ['rooms']})
+            self.assertEqual(await self.receive(connection, 'subscribe_error'), 'The field topic is invalid')
+            await connection.disconnect()
+
+        asyncio.run(test())
+
+
+class ChangeLogTest(SimpleTestCase):
+    """Clients catch up with the changes made after their version, when the log has all of them"""
+
+    def test_deltas_merge_the_changes_of_an_item(self):
+        log = ChangeLog()
+        version = log.version
+        log.add(1, {'name': 'Room'})
+        log.update(1, {'name': 'Renamed'})
+        log.add(2, {'name': 'Other'})
+        log.remove(2)
+        self.assertEqual(log.since(version), [{'op': 'add', 'id': 1, 'item': {'name': 'Renamed'}},
+                                              {'op': 'remove', 'id': 2}])
+        self.assertEqual(log.since(log.version), [])
+
+    def test_versions_of_other_processes_need_a_snapshot(self):
+        log = ChangeLog()
+        for id in range(3):
+            log.add(id, {})
+        # Within the range of the log, but with the tag of another process
+        self.assertIsNone(log.since(log.version - 1))
+        self.assertIsNone(log.since(log.version + 1))
+
+
+class LayerTest(SimpleTestCase):
+    """The hybrid layer delivers to the channels of its process directly and to the others through Redis"""
+
+    class Redis:
+        """The commands of a Redis shard the layer uses, in memory"""
+
+        def __init__(self):
+            self.lists, self.groups, self.pushed = {}, {}, []
+
+        async def eval(self, script, keys=(), args=()):
+            if script == GROUP_MEMBERS_LUA:
+                members = self.groups.get(keys[0], {})
+                return [channel.encode('utf8') for channel in sorted(members, key=members.get)]
+            if keys:
+                # The group send script, each key is followed by its capacity
+                self.pushed += keys
+                for key, message in zip(keys, args):
+                    self.lists.setdefault(key, []).insert(0, message)
+                return 0
+            # The cleanup of the backup list of a receive
+            self.lists.setdefault(args[0], []).extend(self.lists.pop(args[1], []))
+
+        async def zadd(self, key, score, member):
+            self.groups.setdefault(key, {})[member] = score
+
+        async def expire(self, key, seconds):
+            pass
+
+        async def llen(self, key):
+            return len(self.lists.get(key, []))
+
+        async def lpush(self, key, value):
+            self.pushed.append(key)
+            self.lists.setdefault(key, []).insert(0, value)
+
+        async def brpoplpush(self, source, destination, timeout=0):
+            for _ in range(int(timeout * 100)):
+                if self.lists.get(source):
+                    value = self.lists[source].pop()
+                    self.lists.setdefault(destination, []).insert(0, value)
+                    return value
+                await asyncio.sleep(0.01)
+
+        async def brpop(self, key):
+            if self.lists.get(key): return self.lists[key].pop()
+
+    def setUp(self):
+        self.shards = [self.Redis(), self.Redis()]
+
+    def layer(self, **kwargs):
+        layer = HybridChannelLayer(hosts=[('one', 6379), ('two', 6379)], **kwargs)
+        layer.brpop_timeout = 0.05
+
+        @asynccontextmanager
+        async def connection(index):
+            yield self.shards[index]
+
+        layer.connection = connection
+        return layer
+
+    def listen(self, layer, channel, received):
+        async def receive():
+            while True:
+                received.append(await layer.receive(channel))
+
+        task = asyncio.ensure_future(receive())
+        self.listeners.append(task)
+        return task
+
+    def run_layers(self, test):
+        async def run():
+            self.listeners = []
+            try:
+                await test()
+            finally:
+                for task in self.listeners:
+                    task.cancel()
+                await asyncio.gather(*self.listeners, return_exceptions=True)
+
+        asyncio.run(run())
+
+    def test_local_sends_skip_redis(self):
+        async def test():
+            layer = self.layer()
+            channel, received = await layer.new_channel(), []
+            self.listen(layer, channel, received)
+            await asyncio.sleep(0.01)
+            await layer.send(channel, {'type': 'direct'})
+            await asyncio.sleep(0.01)
+            self.assertEqual(received, [{'type': 'direct'}])
+            self.assertEqual(self.shards[0].pushed + self.shards[1].pushed, [])
+
+        self.run_layers(test)
+
+    def test_group_sends_only_push_the_remote_channels(self):
+        async def test():
+            here, there = self.layer(), self.layer()
+            local, other_local, remote = await here.new_channel(), await here.new_channel(), await there.new_channel()
+            received = {local: [], other_local: [], remote: []}
+            for layer, channel in ((here, local), (here, other_local), (there, remote)):
+                self.listen(layer, channel, received[channel])
+                await layer.group_add('room', channel)
+            await asyncio.sleep(0.01)
+            message = {'type': 'hello'}
+            sends = here.fanout.counts[:]
+            await here.group_send('room', message)
+            # The three members fall in the bucket of groups of 3 to 5
+            self.assertEqual(here.fanout.counts[2], sends[2] + 1)
+            await asyncio.sleep(0.2)
+            self.assertEqual(received, {local: [message], other_local: [message], remote: [message]})
+            pushed = self.shards[0].pushed + self.shards[1].pushed
+            self.assertEqual(pushed, [there.prefix + there.non_local_name(remote)])
+            # Every recipient has its own copy
+            received[local][0]['type'] = 'changed'
+            self.assertEqual(received[other_local], [{'type': 'hello'}])
+            self.assertEqual(message, {'type': 'hello'})
+
+        self.run_layers(test)
+
+    def test_cancelled_receives_forget_their_channel(self):
+        async def test():
+            layer = self.layer()
+            channel = await layer.new_channel()
+            receive = self.listen(layer, channel, [])
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(layer.readers), 1)
+            receive.cancel()
+            await asyncio.sleep(0.01)
+            self.assertNotIn(channel, layer.local_channels)
+            self.assertNotIn(channel, layer.receive_buffer)
+            self.assertEqual(layer.readers, {})
+            with self.assertRaisesMessage(ValueError, 'is not a channel of this process'):
+                await layer.receive(channel)
+
+        self.run_layers(test)
+
+    def test_full_channels_refuse_messages(self):
+        async def test():
+            layer = self.layer(capacity=1)
+            channel = await layer.new_channel()
+            self.listen(layer, channel, [])
+            await asyncio.sleep(0.01)
+            await layer.group_add('room', channel)
+            # Nothing is received until the listener runs again, the first message fills the channel
+            await layer.send(channel, {'type': 'first'})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'second'})
+            with self.assertLogs('app.layers', 'WARNING'):
+                await layer.group_send('room', {'type': 'third'})
+
+        self.run_layers(test)
+
+
+class MetricsTest(SimpleTestCase):
+    """The metrics are served in the Prometheus text format"""
+
+    SAMPLE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_]\w*="[^"\n]*"(,[a-zA-Z_]\w*="[^"\n]*")*\})? '
+                        r'(-?\d+(\.\d+)?(e[+-]?\d+)?|[+-]Inf|NaN)')
+    SUFFIXES = {'counter': ('',), 'gauge': ('',), 'histogram': ('_bucket', '_sum', '_count')}
+
+    def test_metrics_are_valid_prometheus_text(self):
+        GROUP_FANOUT.observe(3)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+        text = response.content.decode('utf-8')
+        self.assertTrue(text.endswith('\n'))
+        name, type, samples = None, None, {}
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split()[2]
+                continue
+            if line.startswith('# TYPE '):
+                self.assertEqual(line.split()[2], name, line)
+                type = line.split()[3]
+                self.assertIn(type, self.SUFFIXES, line)
+                continue
+            match = self.SAMPLE.fullmatch(line)
+            self.assertIsNotNone(match, line)
+            self.assertIn(match.group(1), [name + suffix for suffix in self.SUFFIXES[type]], line)
+            samples[match.group(1) + (match.group(2) or '')] = float(match.group(4))
+
+        fanout = 'watch_together_group_fanout'
+        self.assertEqual(samples[f'{fanout}_bucket{{le="+Inf"}}'], samples[f'{fanout}_count'])
+        self.assertGreaterEqual(samples[f'{fanout}_bucket{{le="5"}}'], 1)
+
+
+class DatabaseExecutorTest(SimpleTestCase):
+    """Calls wait for a thread in a bounded queue and for a bounded time, unless they are critical"""
+
+    def setUp(self):
+        self.executor = DatabaseExecutor(workers=1, queue_limit=1, timeout=0.05)
+        self.release = threading.Event()
+        self.addCleanup(self.executor.pool.shutdown)
+        self.addCleanup(self.release.set)
+
+    def block(self):
+        self.release.wait(5)
+        return 'released'
+
+    def test_calls_are_turned_away_when_the_queue_is_full(self):
+        async def test():
+            running = asyncio.ensure_future(self.executor.run(self.block, critical=True))
+            await asyncio.sleep(0.01)
+            waiting = asyncio.ensure_future(self.executor.run(self.block, critical=True))
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.executor.waiting, 1)
+            with self.assertRaises(ServerBusy) as refused:
+                await self.executor.run(lambda: 'refused')
+            self.assertNotIsInstance(refused.exception, DatabaseTimeout)
+            # Critical calls wait whatever the queue
+            critical = asyncio.ensure_future(self.executor.run(lambda: 'critical', critical=True))
+            self.release.set()
+            self.assertEqual(await asyncio.gather(running, waiting, critical), ['released', 'released', 'critical'])
+            self.assertEqual(self.executor.waiting, 0)
+
+        asyncio.run(test())
+
+    def test_slow_calls_time_out_unless_they_are_critical(self):
+        async def test():
+            with self.assertRaises(DatabaseTimeout):
+                await self.executor.run(self.block)
+            self.release.set()
+            self.assertEqual(await self.executor.run(lambda: time.sleep(0.1) or 'written', critical=True), 'written')
+
+        asyncio.run(test())
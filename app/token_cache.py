@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+
+
+class TokenCache:
+    """
+    LRU cache of verified tokens to the id of their user, with a time to live.
+    It is per process, revocations made by other processes are only seen once the entry expires.
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # token -> (user pk, expiry time)
+        self._tokens_by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Return the pk of the user of the token, or None when it has to be verified again"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None: self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, token, user_pk, expires_in=None):
+        ttl = self.ttl if expires_in is None else min(self.ttl, expires_in)
+        if ttl <= 0: return
+        with self._lock:
+            if token in self._entries: self._remove(token)
+            self._entries[token] = (user_pk, time.monotonic() + ttl)
+            self._tokens_by_user.setdefault(user_pk, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, token):
+        with self._lock:
+            if token in self._entries: self._remove(token)
+
+    def invalidate_user(self, user_pk):
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_pk, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _remove(self, token):
+        user_pk, _ = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(user_pk)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens: del self._tokens_by_user[user_pk]
+
+
+token_cache = TokenCache()
@@ -78,9 +78,33 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # The database threads keep their connection between calls
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# A read replica for the read-only handlers (see app/routers.py), none unless REPLICA_DATABASE is set.
+# Locally a copy of the database stands in for it, one that doesn't follow the writes of the primary:
+#   cp db.sqlite3 replica.sqlite3 && REPLICA_DATABASE=replica.sqlite3 python manage.py runserver
+# For a Postgres replica, change the engine and add its host and credentials.
+if os.environ.get('REPLICA_DATABASE'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['REPLICA_DATABASE'],
+        'CONN_MAX_AGE': 60,
+        'TEST': {'MIRROR': 'default'}
+    }
+
+DATABASE_ROUTERS = ['app.routers.ReplicaRouter']
+
+# The threads running the database calls of the consumers (see app/database.py). Each thread keeps
+# a connection to each database, WORKERS times the server processes must stay under what the database accepts.
+DATABASE_EXECUTOR = {
+    'WORKERS': 8,
+    'QUEUE_LIMIT': 256,
+    'TIMEOUT': 10,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -119,9 +143,11 @@ STATIC_URL = '/static/'
 
 AUTH_USER_MODEL = 'app.User'
 
+# Delivers in process to the consumers of the same worker, Redis carries the rest.
+# More hosts shard the groups and channels over several Redis with consistent hashing.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'app.layers.HybridChannelLayer',
         'CONFIG': {
             "hosts": [('localhost', 6379)],
         },